@@ -11,10 +11,13 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 import os
 from pathlib import Path
+import environ
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+env = environ.Env()
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/3.2/howto/deployment/checklist/
@@ -76,6 +79,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'main.context_processors.basket',
             ],
         },
     },
@@ -84,6 +88,15 @@ TEMPLATES = [
 WSGI_APPLICATION = 'ebookstore.wsgi.application'
 ASGI_APPLICATION = 'ebookstore.routing.application'
 
+# In memory unless CACHE_URL says otherwise, e.g. redis://127.0.0.1:6379/1
+# in production, where processes must share the cache
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+# django-environ maps redis:// to django-redis, Django has its own backend
+if CACHES['default']['BACKEND'] == 'django_redis.cache.RedisCache':
+    CACHES['default']['BACKEND'] = 'django.core.cache.backends.redis.RedisCache'
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -174,6 +187,26 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Size of the book image thumbnails, run regenerate_thumbnails after changing it
+THUMBNAIL_SIZE = (150, 150)
+
+# Resized copies rendered for every book image by process_thumbnails,
+# as name: (max width, max height), in each of the formats below
+BOOK_IMAGE_DERIVATIVE_SIZES = {
+    'list': (200, 300),
+    'detail': (400, 600),
+    'zoom': (1000, 1500),
+}
+BOOK_IMAGE_DERIVATIVE_FORMATS = ('webp', 'jpeg')
+
+# Full-text index behind the catalog search, main.search.SimpleSearchBackend
+# works on any database without an index
+SEARCH_BACKEND = 'main.search.SQLiteFTSBackend'
+
+# Seconds after which a process rebuilds its in-memory autocomplete index,
+# picking up books changed by other processes
+AUTOCOMPLETE_MAX_AGE = 300
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -13,7 +13,7 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from main import admin
+from main import admin, views
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
@@ -24,7 +24,7 @@ urlpatterns = [
     path('office-admin/', admin.central_office_admin.urls),
     path('dispatch-admin/', admin.dispatchers_admin.urls),
     path('', include('main.urls')),
-    path('', TemplateView.as_view(template_name='home.html')),
+    path('', views.HomeView.as_view(), name='home'),
     path('about-us/', TemplateView.as_view(template_name='about_us.html')),
     path('api-auth/', include('rest_framework.urls')),
     path('chat/', include('chats.urls')),
@@ -1,10 +1,10 @@
-from datetime import datetime, timedelta
+from datetime import timedelta
 import logging
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
+from django.utils import timezone
 from django.utils.html import format_html
-from django.db.models.functions import TruncDay
-from django.db.models import Count
+from django.db.models import Sum
 from django.urls import path
 from django.template.response import TemplateResponse
 from django.shortcuts import get_object_or_404, render
@@ -12,7 +12,7 @@ from django.http import HttpResponse
 from django.template.loader import render_to_string
 from weasyprint import HTML
 import tempfile
-from . import models, forms
+from . import models, forms, autocomplete, bestsellers, catalog_cache
 
 logger = logging.getLogger(__name__)
 
@@ -60,11 +60,19 @@ class UserAdmin(DjangoUserAdmin):
 
 
 def make_active(self, request, queryset):
-    queryset.update(active=True)
+    # Read before the update, the changelist may be filtered on active
+    ids = list(queryset.values_list("id", flat=True))
+    queryset.update(active=True, date_updated=timezone.now())
+    # update() sends no signals, the suggestions and cached pages are refreshed here
+    autocomplete.refresh_books(ids)
+    catalog_cache.invalidate()
 make_active.short_description = "Mark selected books as active"
 
 def make_inactive(self, request, queryset):
-    queryset.update(active=False)
+    ids = list(queryset.values_list("id", flat=True))
+    queryset.update(active=False, date_updated=timezone.now())
+    autocomplete.refresh_books(ids)
+    catalog_cache.invalidate()
 make_inactive.short_description = "Mark selected books as inactive"
 
 class BookAdmin(admin.ModelAdmin):
@@ -139,8 +147,9 @@ class BookTagAdmin(admin.ModelAdmin):
         else:
             return {}
 class BookImageAdmin(admin.ModelAdmin):
-    list_display = ( "book_name","thumbnail_tag")
-    readonly_fields = ("thumbnail",)
+    list_display = ( "book_name","thumbnail_tag","thumbnail_status")
+    list_filter = ("thumbnail_status",)
+    readonly_fields = ("thumbnail","thumbnail_status")
     search_fields = ("book__name",)
     
     # this function returns HTML for the first column defined
@@ -170,10 +179,61 @@ class BasketLineInline(admin.TabularInline):
     raw_id_fields = ("book",)
 @admin.register(models.Basket)
 class BasketAdmin(admin.ModelAdmin):
-    list_display = ("id", "user", "status", "count")
+    list_display = ("id", "user", "status", "line_count", "item_count", "total_price", "date_updated")
     list_editable = ("status",)
     list_filter = ("status",)
+    list_select_related = ("user",)
     inlines = (BasketLineInline,)
+
+    def get_queryset(self, request):
+        # Totals are computed with the page of baskets, not one by one
+        return super().get_queryset(request).with_totals()
+
+    @admin.display(description="Lines", ordering="line_count")
+    def line_count(self, obj):
+        return obj.line_count
+
+    @admin.display(description="Items", ordering="item_count")
+    def item_count(self, obj):
+        return obj.item_count
+
+    @admin.display(description="Total", ordering="total_price")
+    def total_price(self, obj):
+        # SQLite drops the scale of computed decimals
+        return "%.2f" % obj.total_price
+
+
+class OrderLineBulkSaveMixin:
+    # Saving an order line inline one row at a time fires the status
+    # signal once per line, so the lines are written in bulk and the
+    # order status is recomputed once for the whole formset
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not models.OrderLine:
+            return super().save_formset(request, form, formset, change)
+        instances = formset.save(commit=False)
+        if formset.deleted_objects:
+            models.OrderLine.objects.filter(
+                id__in=[line.id for line in formset.deleted_objects]).delete()
+        # Bulk writes skip the rollup signals, the rollups get the difference
+        # of the order lines instead
+        lines = models.OrderLine.objects.filter(order=form.instance).exclude(
+            status=models.OrderLine.CANCELLED)
+        before = models.OrderRollup.objects.line_totals(lines)
+        models.OrderLine.objects.bulk_create([line for line in instances if line.pk is None])
+        changed_fields = {
+            field for line, fields in formset.changed_objects for field in fields
+            if field in ("book", "status")}
+        if changed_fields:
+            models.OrderLine.objects.bulk_update(
+                [line for line, fields in formset.changed_objects], changed_fields)
+        models.Order.objects.filter(id=form.instance.id).mark_done_if_complete()
+        after = models.OrderRollup.objects.line_totals(lines)
+        changes = {
+            key: [new - old for new, old in zip(after.get(key, (0, 0)), before.get(key, (0, 0)))]
+            for key in before.keys() | after.keys()}
+        models.OrderRollup.objects.add(
+            lines={key: change for key, change in changes.items() if any(change)})
+
 class OrderLineInline(admin.TabularInline):
     model = models.OrderLine
     raw_id_fields = ("book",)
@@ -181,7 +241,7 @@ class OrderLineInline(admin.TabularInline):
     # readonly_fields = ('book',)
 
 @admin.register(models.Order)
-class OrderAdmin(admin.ModelAdmin):
+class OrderAdmin(OrderLineBulkSaveMixin, admin.ModelAdmin):
     list_display = ("id", "user", "status")
     list_editable = ("status",)
     list_filter = ("status", "shipping_county", "date_added")
@@ -217,7 +277,7 @@ class OrderAdmin(admin.ModelAdmin):
 class CentralOfficeOrderLineInline(admin.TabularInline):
     model = models.OrderLine
     readonly_fields = ("book",)
-class CentralOfficeOrderAdmin(admin.ModelAdmin):
+class CentralOfficeOrderAdmin(OrderLineBulkSaveMixin, admin.ModelAdmin):
     list_display = ("id", "user", "status")
     list_editable = ("status",)
     readonly_fields = ("user",)
@@ -249,7 +309,7 @@ class CentralOfficeOrderAdmin(admin.ModelAdmin):
             ),
         )
 # Dispatchers do not need to see the billing address in the fields
-class DispatchersOrderAdmin(admin.ModelAdmin):
+class DispatchersOrderAdmin(OrderLineBulkSaveMixin, admin.ModelAdmin):
     list_display = ("id","shipping_name","date_added","status",)
     list_filter = ("status", "shipping_county", "date_added")
     inlines = (CentralOfficeOrderLineInline,)
@@ -294,10 +354,12 @@ class ReportingColoredAdminSite(ColoredAdminSite):
         return my_urls + urls
     
     def orders_per_day(self, request):
-        starting_day = datetime.now() - timedelta(days=180)
+        # Read from the daily rollups, the cost does not grow with the
+        # order history
+        starting_day = timezone.localdate() - timedelta(days=180)
         order_data = (
-            models.Order.objects.filter(date_added__gt=starting_day).annotate(day=TruncDay("date_added"))
-            .values("day").annotate(c=Count("id")))
+            models.OrderRollup.objects.filter(day__gt=starting_day)
+            .values("day").annotate(c=Sum("orders")).order_by("day"))
         labels = [x["day"].strftime("%Y-%m-%d") for x in order_data]
         values = [x["c"] for x in order_data]
         context = dict(
@@ -310,15 +372,14 @@ class ReportingColoredAdminSite(ColoredAdminSite):
     def most_bought_products(self, request):
         if request.method == "POST":
             form = forms.PeriodSelectForm(request.POST)
+            labels = None
+            values = None
             if form.is_valid():
-                days = form.cleaned_data["period"]
-                starting_day = datetime.now() - timedelta(days=days )
-                data = (models.OrderLine.objects.filter(order__date_added__gt=starting_day)
-                        .values("book__name")
-                        .annotate(c=Count("id")))
-            logger.info("most_bought_books query: %s", data.query)
-            labels = [x["book__name"] for x in data]
-            values = [x["c"] for x in data]
+                # The top books only, ranked and cached by main.bestsellers
+                books = bestsellers.top_books(
+                    form.cleaned_data["window"], form.cleaned_data["limit"])
+                labels = [book["name"] for book in books]
+                values = [book["lines"] for book in books]
         else:
             form = forms.PeriodSelectForm()
             labels = None
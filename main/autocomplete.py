@@ -0,0 +1,240 @@
+'''
+Type-ahead suggestions for the storefront search box.
+
+Titles of active books are kept normalized in the process memory with a
+sorted array of the offsets of their words, a lookup is a binary search followed by a short scan
+and never touches the database. Every word of a title starts a key, so
+"rings" suggests "The Lord of the Rings".
+
+Signals and the admin actions refresh the index of the current process
+incrementally. Other processes catch up when their index is older than
+settings.AUTOCOMPLETE_MAX_AGE seconds and gets rebuilt in a background
+thread, the old index answering until the new one replaces it.
+'''
+import logging
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from django.conf import settings
+from django.db import connection
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    '''Lowercase, without accents and with single spaces'''
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.casefold().split())
+
+
+def word_starts(title):
+    '''Offsets of the words of a normalized title'''
+    return [i for i, c in enumerate(title) if c != " " and (i == 0 or title[i - 1] == " ")]
+
+
+class PrefixIndex:
+    '''
+    Parallel sorted arrays of book ids and word offsets, one entry per word
+    of every title. The key of an entry is its title from that word on,
+    sliced from the normalized title when compared, so the keys themselves
+    are never stored. The name, slug and normalized title of every indexed
+    book are kept by id.
+    '''
+
+    def __init__(self, books=()):
+        self.lock = threading.Lock()
+        self.books = {}
+        entries = []
+        for book_id, name, slug in books:
+            title = normalize(name)
+            self.books[book_id] = (name, slug, title)
+            entries.extend((book_id, start) for start in word_starts(title))
+        entries.sort(key=lambda entry: (self.books[entry[0]][2][entry[1]:], entry[0]))
+        self.ids = array("q", (book_id for book_id, start in entries))
+        self.starts = array("I", (start for book_id, start in entries))
+        self.built = time.monotonic()
+
+    def __len__(self):
+        return len(self.books)
+
+    def key(self, i):
+        return self.books[self.ids[i]][2][self.starts[i]:]
+
+    def _bisect(self, key, book_id=None):
+        '''
+        First entry not below ``key``, ties ordered by id like in the initial
+        sort. Without ``book_id`` the entries are compared on the length of
+        the key only, which finds the first one starting with it.
+        '''
+        lo, hi = 0, len(self.ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            title, start = self.books[self.ids[mid]][2], self.starts[mid]
+            if book_id is None:
+                below = title[start:start + len(key)] < key
+            else:
+                below = (title[start:], self.ids[mid]) < (key, book_id)
+            if below:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _remove(self, book_id):
+        title = self.books[book_id][2]
+        for start in word_starts(title):
+            i = self._bisect(title[start:], book_id)
+            # An entry missing from a diverged index has nothing to remove
+            if i < len(self.ids) and self.ids[i] == book_id and self.starts[i] == start:
+                del self.ids[i]
+                del self.starts[i]
+        del self.books[book_id]
+
+    def _add(self, book_id, name, slug):
+        title = normalize(name)
+        self.books[book_id] = (name, slug, title)
+        for start in word_starts(title):
+            i = self._bisect(title[start:], book_id)
+            self.ids.insert(i, book_id)
+            self.starts.insert(i, start)
+
+    def update(self, books=(), removed=()):
+        '''Replaces the entries of the (id, name, slug) books and drops the removed ids'''
+        with self.lock:
+            for book_id in removed:
+                if book_id in self.books:
+                    self._remove(book_id)
+            for book_id, name, slug in books:
+                if book_id in self.books:
+                    if self.books[book_id][:2] == (name, slug):
+                        continue
+                    self._remove(book_id)
+                self._add(book_id, name, slug)
+
+    def lookup(self, query, limit=10):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        results = []
+        seen = set()
+        with self.lock:
+            i = self._bisect(prefix)
+            while (i < len(self.ids) and len(results) < limit
+                   and self.books[self.ids[i]][2].startswith(prefix, self.starts[i])):
+                book_id = self.ids[i]
+                if book_id not in seen:
+                    seen.add(book_id)
+                    name, slug, title = self.books[book_id]
+                    results.append({"id": book_id, "name": name, "slug": slug})
+                i += 1
+        return results
+
+    def memory_usage(self):
+        '''Approximate number of bytes held by the index'''
+        size = sys.getsizeof(self.ids) + sys.getsizeof(self.starts)
+        size += sys.getsizeof(self.books)
+        for book in self.books.values():
+            size += sys.getsizeof(book) + sum(sys.getsizeof(value) for value in book)
+        return size
+
+
+def active_books():
+    return models.Book.objects.active().values_list("id", "name", "slug").iterator(chunk_size=5000)
+
+
+_index = None
+_build_lock = threading.Lock()
+# Ids of the books changed while a rebuild reads the catalog, None when no
+# rebuild runs
+_changed = None
+
+
+def get_index():
+    '''
+    The index of the process. Only the first use waits for it to be built,
+    an expired index keeps serving while a thread rebuilds it.
+    '''
+    global _index, _changed
+    if _index is None:
+        with _build_lock:
+            if _index is None:
+                _index = PrefixIndex(active_books())
+    elif time.monotonic() - _index.built > settings.AUTOCOMPLETE_MAX_AGE:
+        with _build_lock:
+            if _changed is not None:
+                return _index
+            _changed = set()
+        threading.Thread(target=rebuild_in_background, daemon=True).start()
+    return _index
+
+
+def rebuild():
+    '''Builds a new index from the database and swaps it for the current one'''
+    global _index, _changed
+    try:
+        index = PrefixIndex(active_books())
+    except Exception:
+        with _build_lock:
+            _changed = None
+        raise
+    with _build_lock:
+        _index, changed, _changed = index, _changed or set(), None
+    # Books changed since the catalog was read only reached the old index
+    if changed:
+        refresh_books(changed)
+    logger.info("Rebuilt the autocomplete index of %d books", len(index))
+
+
+def rebuild_in_background():
+    try:
+        rebuild()
+    except Exception:
+        logger.exception("Rebuilding the autocomplete index failed, the old one is kept")
+    finally:
+        # The thread opened its own database connection
+        connection.close()
+
+
+def _record(ids):
+    with _build_lock:
+        if _changed is not None:
+            _changed.update(ids)
+
+
+def refresh_books(ids):
+    '''Brings the entries of the given books in line with the database'''
+    if _index is None:
+        return
+    ids = set(ids)
+    _record(ids)
+    books = list(models.Book.objects.active().filter(id__in=ids).values_list("id", "name", "slug"))
+    _index.update(books, ids - {book_id for book_id, name, slug in books})
+
+
+def refresh_book(book):
+    if _index is None:
+        return
+    _record([book.id])
+    if book.active:
+        _index.update([(book.id, book.name, book.slug)])
+    else:
+        _index.update(removed=[book.id])
+
+
+def remove_books(ids):
+    if _index is not None:
+        _record(ids)
+        _index.update(removed=ids)
+
+
+def reset():
+    global _index, _changed
+    _index = _changed = None
+
+
+def suggest(query, limit=10):
+    return get_index().lookup(query, limit)
@@ -0,0 +1,41 @@
+'''
+Bestselling books over windows of past days, read from the daily order
+rollups.
+
+A ranking is a single ordered and limited aggregate. It is cached in the
+catalog cache, so it goes stale when the orders change (through the
+sales version), when the catalog changes, or after TIMEOUT seconds. The
+day is part of the key, so windows move on at midnight.
+'''
+import datetime
+from django.db.models import Sum
+from django.utils import timezone
+from . import catalog_cache, models
+
+# Windows offered in the reports, in days; any other number of days works
+WINDOWS = (30, 60, 90)
+TIMEOUT = 10 * 60
+
+
+def top_books(days, limit=10, active_only=False):
+    '''
+    [{"id", "name", "slug", "lines", "revenue"}] of the limit books most
+    bought in the last days, today included, best first
+    '''
+    today = timezone.localdate()
+    return catalog_cache.get_or_render(
+        "bestsellers", (catalog_cache.sales_version(), today.isoformat(), days, limit, active_only),
+        lambda: ranking(today, days, limit, active_only), TIMEOUT)
+
+
+def ranking(today, days, limit, active_only):
+    rollups = models.BookOrderRollup.objects.filter(day__gt=today - datetime.timedelta(days=days))
+    if active_only:
+        rollups = rollups.filter(book__active=True)
+    rows = (
+        rollups.values_list("book_id", "book__name", "book__slug")
+        .annotate(lines=Sum("lines"), revenue=Sum("revenue"))
+        .order_by("-lines", "book__name", "book_id")[:limit])
+    return [
+        {"id": book_id, "name": name, "slug": slug, "lines": lines, "revenue": revenue}
+        for book_id, name, slug, lines, revenue in rows]
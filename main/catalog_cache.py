@@ -0,0 +1,98 @@
+'''
+Cache of the rendered storefront.
+
+Everything cached here is keyed with the catalog version, which signals
+bump after any change to books, tags or images. A bump makes the old
+entries unreachable at once and leaves them to expire. Only parts of
+pages that are the same for every visitor may be cached, the basket and
+messages in base.html are rendered per request.
+
+Entries built from orders, like the bestsellers, also carry the sales
+version in their parts, bumped whenever the order rollups change. The
+recommendations version is bumped by build_recommendations, for the
+validators of the book page.
+'''
+import hashlib
+from django.core.cache import cache
+
+TIMEOUT = 60 * 60
+VERSION_KEY = "catalog:version"
+SALES_VERSION_KEY = "catalog:sales-version"
+RECOMMENDATIONS_VERSION_KEY = "catalog:recommendations-version"
+STATS_KEY = "catalog:stats:%s:%s"
+
+
+def version():
+    return cache.get_or_set(VERSION_KEY, 1, None)
+
+
+def invalidate():
+    bump(VERSION_KEY)
+
+
+def sales_version():
+    return cache.get_or_set(SALES_VERSION_KEY, 1, None)
+
+
+def invalidate_sales():
+    bump(SALES_VERSION_KEY)
+
+
+def recommendations_version():
+    return cache.get_or_set(RECOMMENDATIONS_VERSION_KEY, 1, None)
+
+
+def invalidate_recommendations():
+    bump(RECOMMENDATIONS_VERSION_KEY)
+
+
+def bump(version_key):
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        cache.set(version_key, 1, None)
+
+
+def key(name, *parts):
+    digest = hashlib.md5(repr(parts).encode()).hexdigest()
+    return "catalog:%s:%d:%s" % (name, version(), digest)
+
+
+def count(name, outcome):
+    stats_key = STATS_KEY % (name, outcome)
+    # add() is a no-op when the counter exists, incr() is atomic on
+    # shared backends
+    cache.add(stats_key, 0, None)
+    try:
+        cache.incr(stats_key)
+    except ValueError:
+        pass
+
+
+def get_or_render(name, parts, render, timeout=TIMEOUT):
+    '''The cached value of name for parts, rendered and stored on a miss'''
+    cache_key = key(name, *parts)
+    value = cache.get(cache_key)
+    if value is None:
+        count(name, "misses")
+        value = render()
+        cache.set(cache_key, value, timeout)
+    else:
+        count(name, "hits")
+    return value
+
+
+def stats(names):
+    '''{name: {"hits": n, "misses": n}} since the counters were last reset'''
+    values = cache.get_many([
+        STATS_KEY % (name, outcome) for name in names for outcome in ("hits", "misses")])
+    return {
+        name: {
+            outcome: values.get(STATS_KEY % (name, outcome), 0)
+            for outcome in ("hits", "misses")}
+        for name in names}
+
+
+def reset_stats(names):
+    cache.delete_many([
+        STATS_KEY % (name, outcome) for name in names for outcome in ("hits", "misses")])
@@ -0,0 +1,7 @@
+from django.utils.functional import SimpleLazyObject
+from .middlewares import basket_summary
+
+
+def basket(request):
+    '''The header badge reads the basket summary, never the basket'''
+    return {"basket_summary": SimpleLazyObject(lambda: basket_summary(request))}
@@ -1,18 +1,61 @@
-from rest_framework import serializers,viewsets
-from . import models
+from django.db import transaction
+from rest_framework import permissions, serializers, viewsets
+from rest_framework.decorators import action
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from . import models, search
 
 class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
     book = serializers.StringRelatedField()
     class Meta:
         model = models.OrderLine
         fields = ('id', 'order', 'book', 'status')
-        read_only_fields = ('id', 'order', 'product')
+        read_only_fields = ('id', 'order', 'book')
+
+class OrderLineBulkStatusSerializer(serializers.Serializer):
+    # SQLite refuses statements with more than 32766 parameters
+    MAX_IDS = 10000
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=MAX_IDS)
+    status = serializers.ChoiceField(choices=models.OrderLine.STATUSES)
+
+class ChangeModelPermissions(permissions.DjangoModelPermissions):
+    # A bulk status change is a POST but only modifies existing lines
+    perms_map = dict(
+        permissions.DjangoModelPermissions.perms_map,
+        POST=['%(app_label)s.change_%(model_name)s'])
 
 class PaidOrderLineViewSet(viewsets.ModelViewSet):
     queryset = models.OrderLine.objects.filter(order__status=models.Order.PAID).order_by("-order__date_added")
     serializer_class = OrderLineSerializer
     filter_fields = ('order', 'status')
 
+    def perform_update(self, serializer):
+        # Status changes go through the bulk service, which propagates
+        # the status to the order without the per-line signal
+        line = serializer.instance
+        status = serializer.validated_data.get("status", line.status)
+        self.get_queryset().filter(id=line.id).set_status(status)
+        line.status = status
+
+    @action(detail=False, methods=["post"], url_path="bulk-status",
+            permission_classes=[ChangeModelPermissions])
+    def bulk_status(self, request):
+        serializer = OrderLineBulkStatusSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = set(serializer.validated_data["ids"])
+        status = serializer.validated_data["status"]
+        with transaction.atomic():
+            lines = self.get_queryset().filter(id__in=ids)
+            found = set(lines.values_list("id", flat=True))
+            if found:
+                lines.set_status(status)
+        return Response({
+            "status": status,
+            "updated": sorted(found),
+            "not_found": sorted(ids - found),
+            })
+
 class OrderSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = models.Order
@@ -20,4 +63,28 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
                   'shipping_county','date_updated','date_added')
 class PaidOrderViewSet(viewsets.ModelViewSet):
     queryset = models.Order.objects.filter(status=models.Order.PAID).order_by("-date_added")
-    serializer_class = OrderSerializer
\ No newline at end of file
+    serializer_class = OrderSerializer
+class BookSearchSerializer(serializers.ModelSerializer):
+    tags = serializers.StringRelatedField(many=True)
+    class Meta:
+        model = models.Book
+        fields = ('id', 'name', 'slug', 'description', 'price', 'in_stock', 'tags')
+
+class BookSearchPagination(PageNumberPagination):
+    page_size = 20
+
+class BookSearchViewSet(viewsets.GenericViewSet):
+    serializer_class = BookSearchSerializer
+    pagination_class = BookSearchPagination
+    permission_classes = [permissions.AllowAny]
+    filter_backends = []
+
+    def get_queryset(self):
+        return search.search(
+            self.request.query_params.get("q", ""),
+            models.Book.objects.active().prefetch_related("tags"))
+
+    def list(self, request):
+        page = self.paginate_queryset(self.get_queryset())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
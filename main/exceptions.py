@@ -0,0 +1,2 @@
+class BasketException(Exception):
+    '''Raised when a basket cannot be turned into an order'''
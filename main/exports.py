@@ -0,0 +1,63 @@
+'''
+Catalog export as CSV or JSON Lines. Books are read a chunk at a time
+and written out one line at a time, so memory use does not grow with
+the size of the catalog. The CSV columns are the ones import_data reads.
+'''
+import csv
+import json
+from django.db.models import Prefetch
+from . import models
+
+CSV_FIELDS = ("name", "description", "tags", "image_filename", "price")
+
+
+def catalog_books(active_only=False, chunk_size=500):
+    books = models.Book.objects.order_by("id").prefetch_related(
+        Prefetch("tags", queryset=models.BookTag.objects.only("name")),
+        Prefetch(
+            "bookimage_set",
+            queryset=models.BookImage.objects.only("book_id", "image").order_by("id")))
+    if active_only:
+        books = books.filter(active=True)
+    return books.iterator(chunk_size=chunk_size)
+
+
+class Echo:
+    # A file-like object for csv.writer that hands lines back instead of storing them
+    def write(self, value):
+        return value
+
+
+def csv_lines(books):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_FIELDS)
+    for book in books:
+        images = book.bookimage_set.all()
+        yield writer.writerow([
+            book.name,
+            book.description,
+            "|".join(tag.name for tag in book.tags.all()),
+            # Image names are relative to MEDIA_ROOT, the image_basedir to re-import with
+            images[0].image.name if images else "",
+            book.price,
+            ])
+
+
+def jsonl_lines(books):
+    for book in books:
+        yield json.dumps({
+            "name": book.name,
+            "slug": book.slug,
+            "description": book.description,
+            "price": str(book.price),
+            "active": book.active,
+            "in_stock": book.in_stock,
+            "tags": [tag.name for tag in book.tags.all()],
+            "images": [image.image.name for image in book.bookimage_set.all()],
+            }) + "\n"
+
+
+FORMATS = {
+    "csv": (csv_lines, "text/csv"),
+    "jsonl": (jsonl_lines, "application/jsonl"),
+    }
@@ -0,0 +1,123 @@
+'''
+Faceted navigation of the catalog: tags, price buckets and stock.
+
+Within a facet the selected values are alternatives, across facets they
+must all hold. The count shown next to a value is the number of books
+having it among those matching the selection in the other facets. The
+counts come from two queries, an aggregate for the totals and price
+buckets and a GROUP BY over the tag links for the tags, cached until a
+book or tag changes.
+'''
+import json
+from urllib.parse import urlencode
+from decimal import Decimal
+from django.db.models import Count, Exists, OuterRef, Q
+from . import catalog_cache, models
+
+# slug, label, lower bound (inclusive), upper bound (exclusive)
+PRICE_BUCKETS = (
+    ("under-10", "Under 10", None, Decimal("10")),
+    ("10-20", "10 to 20", Decimal("10"), Decimal("20")),
+    ("20-50", "20 to 50", Decimal("20"), Decimal("50")),
+    ("50-plus", "50 and over", Decimal("50"), None),
+)
+
+
+def active_tags():
+    '''(id, slug, name) of the tags to facet on'''
+    return catalog_cache.get_or_render(
+        "facet-tags", (),
+        lambda: list(models.BookTag.objects.filter(active=True).order_by("name").values_list(
+            "id", "slug", "name")))
+
+
+class Selection:
+    '''The facet values selected in a query string'''
+
+    def __init__(self, query_dict):
+        tags = {slug: tag_id for tag_id, slug, name in active_tags()}
+        buckets = {bucket[0] for bucket in PRICE_BUCKETS}
+        self.tag_slugs = sorted(set(query_dict.getlist("tag")) & tags.keys())
+        self.tags = sorted(tags[slug] for slug in self.tag_slugs)
+        self.prices = sorted(set(query_dict.getlist("price")) & buckets)
+        self.in_stock = query_dict.get("in_stock") == "1"
+
+    def __bool__(self):
+        return bool(self.tags or self.prices or self.in_stock)
+
+    def key(self):
+        return json.dumps([self.tags, self.prices, self.in_stock])
+
+    def query_string(self):
+        '''The selection as a query string, to carry it over in links'''
+        params = [("tag", slug) for slug in self.tag_slugs]
+        params += [("price", slug) for slug in self.prices]
+        if self.in_stock:
+            params.append(("in_stock", "1"))
+        return urlencode(params)
+
+    def tags_q(self, tag_ids=None):
+        tag_ids = self.tags if tag_ids is None else tag_ids
+        if not tag_ids:
+            return Q()
+        return Q(Exists(models.Book.tags.through.objects.filter(
+            book_id=OuterRef("pk"), booktag_id__in=tag_ids)))
+
+    def prices_q(self, slugs=None):
+        slugs = self.prices if slugs is None else slugs
+        q = Q()
+        for slug, label, low, high in PRICE_BUCKETS:
+            if slug in slugs:
+                bucket = Q()
+                if low is not None:
+                    bucket &= Q(price__gte=low)
+                if high is not None:
+                    bucket &= Q(price__lt=high)
+                q |= bucket
+        return q
+
+    def stock_q(self, in_stock=None):
+        in_stock = self.in_stock if in_stock is None else in_stock
+        return Q(in_stock=True) if in_stock else Q()
+
+    def filter(self, queryset):
+        return queryset.filter(self.tags_q() & self.prices_q() & self.stock_q())
+
+    def counts(self, queryset, cache_key):
+        '''
+        Counts for every facet value, cached under cache_key which must
+        identify queryset
+        '''
+        return catalog_cache.get_or_render(
+            "facets", (cache_key, self.key()), lambda: self._counts(queryset))
+
+    def _counts(self, queryset):
+        def count(q):
+            return Count("id", filter=q) if q else Count("id")
+        aggregates = {
+            "total": count(self.tags_q() & self.prices_q() & self.stock_q()),
+            "in_stock": count(self.tags_q() & self.prices_q() & self.stock_q(True)),
+            }
+        for slug, label, low, high in PRICE_BUCKETS:
+            aggregates["price_%s" % slug] = count(
+                self.tags_q() & self.prices_q([slug]) & self.stock_q())
+        counts = queryset.aggregate(**aggregates)
+        # Grouping the links of the matching books costs one pass over them,
+        # where a filtered count per tag would go over the books once a tag
+        tag_ids = [tag_id for tag_id, slug, name in active_tags()]
+        tag_counts = dict(
+            models.Book.tags.through.objects
+            .filter(
+                book__in=queryset.filter(self.prices_q() & self.stock_q()).values("id"),
+                booktag_id__in=tag_ids)
+            .values_list("booktag_id").annotate(count=Count("book_id")).order_by())
+        return {
+            "total": counts["total"],
+            "in_stock": counts["in_stock"],
+            "tags": [
+                (slug, name, tag_counts.get(tag_id, 0), tag_id in self.tags)
+                for tag_id, slug, name in active_tags()],
+            "prices": [
+                (slug, label, counts["price_%s" % slug], slug in self.prices)
+                for slug, label, low, high in PRICE_BUCKETS],
+            }
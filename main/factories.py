@@ -9,6 +9,7 @@ class UserFactory(factory.django.DjangoModelFactory):
 
 class BookFactory(factory.django.DjangoModelFactory):
     price = Decimal("80")
+    slug = factory.Sequence(lambda n: "book-%d" % n)
     
     class Meta:
         model = models.Book
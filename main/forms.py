@@ -3,7 +3,7 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm as DjangoUserCreationForm
 from django.contrib.auth.forms import UsernameField
 from django.core.mail import send_mail
-from .models import User,Basket,BasketLine, Address
+from .models import User,Basket,BasketLine, Address, Book
 from django.contrib.auth import authenticate
 from django.forms import widgets, inlineformset_factory
 from . import widgets
@@ -66,6 +66,21 @@ BasketLineFormSet = inlineformset_factory(
     fields=("quantity",),
     extra=0,widgets={"quantity":widgets.PlusMinusNumberInput()})
 
+class BasketLineForm(forms.Form):
+    '''A book and a quantity posted to the basket API'''
+    book_id = forms.ModelChoiceField(queryset=Book.objects.all())
+    quantity = forms.IntegerField(min_value=0)
+
+
+class BasketAddForm(BasketLineForm):
+    book_id = forms.ModelChoiceField(queryset=Book.objects.active())
+    quantity = forms.IntegerField(min_value=1, required=False)
+
+
+class BasketRemoveForm(BasketLineForm):
+    quantity = None
+
+
 class AddressSelectionForm(forms.Form):
     billing_address = forms.ModelChoiceField(queryset=None)
     shipping_address = forms.ModelChoiceField(queryset=None)
@@ -78,4 +93,16 @@ class AddressSelectionForm(forms.Form):
         
 class PeriodSelectForm(forms.Form):
     PERIODS = ((30, "30 days"), (60, "60 days"), (90, "90 days"))
-    period = forms.TypedChoiceField(choices=PERIODS, coerce=int, required=True)
\ No newline at end of file
+    period = forms.TypedChoiceField(choices=PERIODS, coerce=int, required=False)
+    days = forms.IntegerField(
+        min_value=1, max_value=3650, required=False, label="Or number of days")
+    limit = forms.IntegerField(min_value=1, max_value=100, initial=20, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # A custom number of days wins over the preset periods
+        cleaned_data["window"] = cleaned_data.get("days") or cleaned_data.get("period")
+        if not cleaned_data["window"]:
+            raise forms.ValidationError("Choose a period or a number of days.")
+        cleaned_data["limit"] = cleaned_data.get("limit") or self.fields["limit"].initial
+        return cleaned_data
\ No newline at end of file
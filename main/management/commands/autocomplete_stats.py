@@ -0,0 +1,31 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from main import autocomplete
+
+
+class Command(BaseCommand):
+    help = 'Build the autocomplete index and report its size and lookup speed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lookups", type=int, default=10000,
+            help="Number of random title prefixes to look up")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        index = autocomplete.PrefixIndex(autocomplete.active_books())
+        build_time = time.perf_counter() - start
+        self.stdout.write("Books indexed=%d (keys=%d)" % (len(index), len(index.ids)))
+        self.stdout.write("Built in %.2fs" % build_time)
+        self.stdout.write("Memory used=%.1f MiB" % (index.memory_usage() / 2 ** 20))
+        if not index.ids:
+            return
+        keys = (index.key(i) for i in random.choices(range(len(index.ids)), k=options["lookups"]))
+        prefixes = [key[:random.randint(1, min(len(key), 8))] for key in keys]
+        start = time.perf_counter()
+        for prefix in prefixes:
+            index.lookup(prefix)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            "Lookups=%d (%.1fus per lookup)" % (len(prefixes), elapsed / len(prefixes) * 1e6))
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from main import models
+
+
+class Command(BaseCommand):
+    help = 'Queue book images that are missing derivatives for rendering'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="Queue every image, e.g. after changing the derivative sizes")
+        parser.add_argument(
+            "--process", action="store_true",
+            help="Render the queue right away instead of leaving it to the worker")
+        parser.add_argument("--workers", type=int)
+
+    def handle(self, *args, **options):
+        images = models.BookImage.objects.exclude(thumbnail_status=models.BookImage.PENDING)
+        if not options["all"]:
+            sizes = settings.BOOK_IMAGE_DERIVATIVE_SIZES
+            formats = settings.BOOK_IMAGE_DERIVATIVE_FORMATS
+            images = images.annotate(
+                current_derivatives=Count(
+                    "derivatives",
+                    filter=Q(derivatives__size__in=sizes, derivatives__format__in=formats)),
+                ).filter(current_derivatives__lt=len(sizes) * len(formats))
+        # Updating through a pk subquery keeps this to one statement
+        queued = models.BookImage.objects.filter(
+            id__in=images.values("id")).update(thumbnail_status=models.BookImage.PENDING)
+        self.stdout.write("Images queued=%d" % queued)
+        if options["process"]:
+            worker_options = {"once": True, "stdout": self.stdout}
+            if options["workers"]:
+                worker_options["workers"] = options["workers"]
+            call_command("process_thumbnails", **worker_options)
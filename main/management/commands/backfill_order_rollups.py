@@ -0,0 +1,71 @@
+import collections
+import datetime
+import logging
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from main import catalog_cache, models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily order rollups read by the admin reports from the orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=None,
+            help="Only rebuild this many past days, the whole history otherwise")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        orders = models.Order.objects.all()
+        rollups = models.OrderRollup.objects.all()
+        book_rollups = models.BookOrderRollup.objects.all()
+        if options["days"] is not None:
+            first_day = timezone.localdate() - datetime.timedelta(days=options["days"])
+            orders = orders.filter(date_added__gte=timezone.make_aware(
+                datetime.datetime.combine(first_day, datetime.time.min)))
+            rollups = rollups.filter(day__gte=first_day)
+            book_rollups = book_rollups.filter(day__gte=first_day)
+
+        # Days are those of the current time zone, like in the incremental
+        # updates
+        order_counts = (
+            orders.annotate(day=TruncDate("date_added"))
+            .values_list("day", "shipping_county").annotate(orders=Count("id")).order_by())
+        book_rows = [
+            models.BookOrderRollup(
+                day=day, county=county, book_id=book_id, lines=lines, revenue=revenue)
+            for day, county, book_id, lines, revenue in models.OrderLine.objects
+            .filter(order__in=orders).exclude(status=models.OrderLine.CANCELLED)
+            .annotate(day=TruncDate("order__date_added"))
+            .values_list("day", "order__shipping_county", "book_id")
+            .annotate(lines=Count("id"), revenue=Sum("book__price")).order_by()]
+        totals = collections.defaultdict(lambda: [0, Decimal(0)])
+        for row in book_rows:
+            total = totals[row.day, row.county]
+            total[0] += row.lines
+            total[1] += row.revenue
+        order_rows = [
+            models.OrderRollup(
+                day=day, county=county, orders=count,
+                lines=totals[day, county][0], revenue=totals[day, county][1])
+            for day, county, count in order_counts]
+        computed = time.perf_counter()
+        self.stdout.write(
+            "Days and counties=%d, book rows=%d computed in %.1fs"
+            % (len(order_rows), len(book_rows), computed - start))
+
+        with transaction.atomic():
+            rollups.delete()
+            book_rollups.delete()
+            models.OrderRollup.objects.bulk_create(order_rows, batch_size=options["batch_size"])
+            models.BookOrderRollup.objects.bulk_create(book_rows, batch_size=options["batch_size"])
+            transaction.on_commit(catalog_cache.invalidate_sales)
+        self.stdout.write("Rollups stored in %.1fs" % (time.perf_counter() - computed))
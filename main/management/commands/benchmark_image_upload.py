@@ -0,0 +1,78 @@
+import os.path
+import statistics
+import tempfile
+import time
+from decimal import Decimal
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.signals import pre_save
+from django.test import Client, override_settings
+from django.urls import reverse
+from main import models, thumbnails
+
+
+def render_inline(sender, instance, **kwargs):
+    # What the pre_save signal used to do before thumbnails were queued
+    if instance.image._committed:
+        return
+    data = b"".join(instance.image.chunks())
+    instance.thumbnail.save(
+        instance.image.name,
+        ContentFile(thumbnails.render_thumbnail(data, settings.THUMBNAIL_SIZE)), save=False)
+    instance.thumbnail_status = models.BookImage.READY
+
+
+class Command(BaseCommand):
+    help = 'Compare the latency of admin image uploads with inline and queued thumbnails'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "image", nargs="?", type=str,
+            default="main/fixtures/mitch-rap-book-series.jpeg")
+        parser.add_argument("--iterations", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with open(options["image"], "rb") as f:
+            data = f.read()
+        name = os.path.basename(options["image"])
+        # Everything happens in a throwaway media root and is rolled back
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+                MEDIA_ROOT=media_root, ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ["testserver"]):
+            with transaction.atomic():
+                book = models.Book.objects.create(
+                    name="Benchmark", slug="benchmark", price=Decimal("1.00"))
+                client = Client()
+                client.force_login(models.User.objects.create_superuser(
+                    "benchmark@ebookstore.domain", None))
+                pre_save.connect(render_inline, sender=models.BookImage)
+                try:
+                    inline = self.time_uploads(client, book, name, data, options["iterations"])
+                finally:
+                    pre_save.disconnect(render_inline, sender=models.BookImage)
+                results = {
+                    "inline": inline,
+                    "queued": self.time_uploads(client, book, name, data, options["iterations"]),
+                    }
+                transaction.set_rollback(True)
+        for mode, timings in results.items():
+            self.stdout.write("%s: median=%.1fms mean=%.1fms max=%.1fms" % (
+                mode,
+                statistics.median(timings) * 1000,
+                statistics.mean(timings) * 1000,
+                max(timings) * 1000))
+
+    def time_uploads(self, client, book, name, data, iterations):
+        '''Posts the image to the admin add view, form handling and signals included'''
+        url = reverse("admin:main_bookimage_add")
+        timings = []
+        for i in range(iterations):
+            upload = SimpleUploadedFile(name, data, content_type="image/jpeg")
+            start = time.perf_counter()
+            response = client.post(url, {"book": book.id, "image": upload})
+            timings.append(time.perf_counter() - start)
+            if response.status_code != 302:
+                raise CommandError("The admin refused the upload (status %d)" % response.status_code)
+        return timings
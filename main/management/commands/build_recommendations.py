@@ -0,0 +1,51 @@
+import itertools
+import logging
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main import catalog_cache, models, recommendations
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the "customers also bought" recommendations from the order history'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=10, help="Recommendations kept per book")
+        parser.add_argument(
+            "--min-count", type=int, default=1,
+            help="Orders two books must share to be recommended together")
+        parser.add_argument("--block-size", type=int, default=4096)
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        lines = (
+            models.OrderLine.objects.exclude(status=models.OrderLine.CANCELLED)
+            .values_list("order_id", "book_id").iterator(chunk_size=20000))
+        pairs = np.fromiter(itertools.chain.from_iterable(lines), dtype=np.int64).reshape(-1, 2)
+        loaded = time.perf_counter()
+        self.stdout.write("Order lines read=%d in %.1fs" % (len(pairs), loaded - start))
+
+        books, neighbours, ranks, scores = recommendations.co_purchases(
+            pairs, options["top"], options["min_count"], options["block_size"])
+        computed = time.perf_counter()
+        self.stdout.write("Recommendations computed=%d in %.1fs" % (len(books), computed - loaded))
+
+        rows = (
+            models.BookRecommendation(
+                book_id=book, recommended_id=neighbour, rank=rank, score=score)
+            for book, neighbour, rank, score in zip(
+                books.tolist(), neighbours.tolist(), ranks.tolist(), scores.tolist()))
+        with transaction.atomic():
+            models.BookRecommendation.objects.all().delete()
+            while True:
+                batch = list(itertools.islice(rows, options["batch_size"]))
+                if not batch:
+                    break
+                models.BookRecommendation.objects.bulk_create(batch)
+            transaction.on_commit(catalog_cache.invalidate)
+            transaction.on_commit(catalog_cache.invalidate_recommendations)
+        self.stdout.write("Recommendations stored in %.1fs" % (time.perf_counter() - computed))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from main import exports
+
+
+class Command(BaseCommand):
+    help = 'Export books in ebookstore, the csv format can be read by import_data'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=exports.FORMATS, default="csv")
+        parser.add_argument("--output", type=str, help="File to write to instead of stdout")
+        parser.add_argument("--active", action="store_true", help="Only export active books")
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        lines, content_type = exports.FORMATS[options["format"]]
+        books = exports.catalog_books(options["active"], options["chunk_size"])
+        if options["output"]:
+            with open(options["output"], "w", newline="") as f:
+                f.writelines(lines(books))
+        else:
+            for line in lines(books):
+                self.stdout.write(line, ending="")
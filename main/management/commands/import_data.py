@@ -1,10 +1,106 @@
+import hashlib
+import logging
+import os
 import os.path
 import csv
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from collections import Counter
-from django.core.files.images import ImageFile
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
 from django.template.defaultfilters import slugify
-from main import models
+from django.utils import timezone
+from main import catalog_cache, models, search, thumbnails
+
+logger = logging.getLogger(__name__)
+
+
+def row_tags(row):
+    return [tag for tag in row["tags"].split("|") if tag]
+
+
+# Columns telling apart the books of a feed without ISBNs, two books may
+# share a title
+KEY_COLUMNS = ("name", "image_filename")
+
+
+def row_key(row):
+    '''
+    The stable identifier of a book in the feed, its ISBN when the feed has
+    one and otherwise a hash of its KEY_COLUMNS, at most 64 characters
+    '''
+    if row.get("isbn"):
+        return row["isbn"][:64]
+    digest = hashlib.sha256()
+    for column in KEY_COLUMNS:
+        digest.update(row[column].encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def delete_images(images):
+    '''Deletes the BookImage queryset, and its files once the transaction commits'''
+    names = [name for row in images.values_list("image", "thumbnail") for name in row if name]
+    names.extend(models.BookImageDerivative.objects.filter(
+        book_image__in=images).values_list("file", flat=True))
+    images.delete()
+    transaction.on_commit(lambda: [default_storage.delete(name) for name in names])
+
+
+def row_checksum(row, image_path):
+    '''
+    Returns the checksum of the row and the OSError met looking up its
+    image, if any
+    '''
+    # The image is fingerprinted by its size and modification time, so
+    # that unchanged rows are skipped without reading their image
+    try:
+        image_stat = os.stat(image_path)
+    except OSError as e:
+        image_fingerprint = ("missing", "")
+        error = e
+    else:
+        image_fingerprint = (str(image_stat.st_size), str(image_stat.st_mtime_ns))
+        error = None
+    digest = hashlib.sha256()
+    for value in (
+            row["name"], row["price"], row["description"], "|".join(row_tags(row)),
+            row["image_filename"], *image_fingerprint):
+        digest.update(value.encode())
+        digest.update(b"\0")
+    return digest.hexdigest(), error
+
+
+def unique_slug(book, name, is_taken):
+    '''
+    A slug for name which no other book has, numbered like "emma-2" if
+    needed. The current slug is kept while it still matches the name.
+    '''
+    base = slugify(name)
+    if book.slug and re.fullmatch(r"%s(-\d+)?" % re.escape(base), book.slug):
+        return book.slug
+    slug = base
+    n = 1
+    while is_taken(slug):
+        n += 1
+        suffix = "-%d" % n
+        slug = base[:50 - len(suffix)] + suffix
+    return slug
+
+
+def fill_book(book, row, checksum, is_taken):
+    book.name = row["name"]
+    book.price = models.Book._meta.get_field("price").to_python(row["price"])
+    book.description = row["description"]
+    book.slug = unique_slug(book, row["name"], is_taken)
+    book.import_key = row_key(row)
+    book.import_checksum = checksum
 
 
 class Command(BaseCommand):
@@ -13,35 +109,263 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("csvfile", type=open)
         parser.add_argument("image_basedir", type=str)
+        parser.add_argument(
+            "--bulk", action="store_true",
+            help="Write rows with bulk queries, one transaction per batch")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--image-workers", type=int, default=os.cpu_count(),
+            help="Processes copying images and rendering thumbnails in bulk mode")
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Import every row, even those unchanged since the last import")
 
     def handle(self, *args, **options):
         self.stdout.write("Importing products...")
         c = Counter()
+        self.image_failures = []
+        start = time.perf_counter()
         reader = csv.DictReader(options.pop("csvfile"))
+        if options["bulk"]:
+            self.import_bulk(reader, options, c)
+        else:
+            self.import_rows(reader, options, c)
+        elapsed = time.perf_counter() - start
+        self.stdout.write("Books processed=%d (created=%d, updated=%d, unchanged=%d)" %
+                          (c["books"], c["books_created"], c["books_updated"], c["books_unchanged"]))
+        self.stdout.write("Tags processed=%d (created=%d)" %
+                          (c["tags"], c["tags_created"]))
+        self.stdout.write("Images processed=%d (failed=%d)" % (c["images"], c["images_failed"]))
+        for filename, error in self.image_failures:
+            self.stdout.write("Image %s failed: %s" % (filename, error))
+        self.stdout.write("Rows per second=%.1f, images per second=%.1f" % (
+            c["books"] / elapsed if elapsed else 0, c["images"] / elapsed if elapsed else 0))
+
+    def image_failed(self, row, error, c):
+        logger.error("Cannot import image %s", row["image_filename"], exc_info=error)
+        self.image_failures.append((row["image_filename"], error))
+        c["images_failed"] += 1
+
+    def import_rows(self, reader, options, c):
         for row in reader:
-            book, created = models.Book.get_or_create(
-                name=row["name"], price=row["price"]
-            )
-            book.description = row["description"]
-            book.slug = slugify(row["name"])
-            for import_tag in row["tags"].split("|"):
+            c["books"] += 1
+            image_path = os.path.join(options["image_basedir"], row["image_filename"])
+            checksum, image_error = row_checksum(row, image_path)
+            key = row_key(row)
+            book = models.Book.objects.filter(import_key=key).first()
+            if book is None:
+                # Books imported before import keys existed are matched by
+                # slug, as are those keyed by slug, and get the new key
+                name_slug = slugify(row["name"])
+                book = models.Book.objects.filter(
+                    Q(import_key=None, slug=name_slug) | Q(import_key=name_slug)).first()
+            if (book and book.import_key == key and book.import_checksum == checksum
+                    and not options["force"]):
+                c["books_unchanged"] += 1
+                continue
+            if book is None:
+                book = models.Book()
+                c["books_created"] += 1
+            else:
+                c["books_updated"] += 1
+            data = None
+            if not image_error:
+                try:
+                    with open(image_path, "rb") as f:
+                        data = f.read()
+                except OSError as e:
+                    image_error = e
+            # Without its image the row keeps its old checksum, so that the
+            # next import tries it again
+            fill_book(
+                book, row, book.import_checksum if image_error else checksum,
+                lambda slug: models.Book.objects.filter(slug=slug).exclude(pk=book.pk).exists())
+            book.save()
+            tags = []
+            for import_tag in row_tags(row):
                 tag, tag_created = models.BookTag.objects.get_or_create(
-                    name=import_tag)
-                book.tags.add(tag)
+                    name=import_tag, defaults={"slug": slugify(import_tag)})
+                tags.append(tag)
                 c["tags"] += 1
                 if tag_created:
                     c["tags_created"] += 1
-            with open(os.path.join(options["image_basedir"], row["image_filename"]), "rb") as f:
-                image = models.BookImage(
-                    book=book, image=ImageFile(f, name=row["image_filename"]))
+            book.tags.set(tags)
+            if image_error:
+                self.image_failed(row, image_error, c)
+                continue
+            image = models.BookImage(
+                book=book, image=ContentFile(data, name=os.path.basename(row["image_filename"])))
+            image.image_hash = thumbnails.content_hash(image.image)
+            if not book.bookimage_set.filter(image_hash=image.image_hash).exists():
+                # The feed has one image per book, a new one replaces the old
+                delete_images(book.bookimage_set.all())
                 image.save()
                 c["images"] += 1
-            book.save()
+
+    def import_bulk(self, reader, options, c):
+        # Existing books and tags are loaded once, so that a batch only
+        # needs queries to write, never to look rows up
+        books = {}
+        legacy_books = {}
+        slugs = set()
+        for book in models.Book.objects.only("id", "slug", "import_key", "import_checksum"):
+            slugs.add(book.slug)
+            if book.import_key:
+                books[book.import_key] = book
+            else:
+                legacy_books.setdefault(book.slug, book)
+        tags = {tag.name: tag for tag in models.BookTag.objects.only("id", "name")}
+        # The csv reader is consumed one batch at a time, so memory use
+        # only depends on the batch size
+        rows = iter(reader)
+        with ProcessPoolExecutor(max_workers=options["image_workers"]) as pool:
+            # The pool works on the images of a batch while the next batch is
+            # read and written, they are stored one batch later
+            jobs = []
+            while True:
+                batch = list(islice(rows, options["batch_size"]))
+                next_jobs = []
+                if batch:
+                    with transaction.atomic():
+                        next_jobs = self.import_batch(
+                            batch, books, legacy_books, slugs, tags, pool, options, c)
+                    if options["verbosity"] > 1:
+                        self.stdout.write("Rows read=%d" % c["books"])
+                if jobs:
+                    with transaction.atomic():
+                        self.store_images(jobs, c)
+                if not batch:
+                    break
+                jobs = next_jobs
+        # Bulk writes send no signals
+        catalog_cache.invalidate()
+
+    def import_batch(self, batch, books, legacy_books, slugs, tags, pool, options, c):
+        '''
+        Writes the books and tags of the batch and returns its image jobs,
+        running in the pool, for store_images()
+        '''
+        changed = []
+        changed_books = {}
+        for row in batch:
             c["books"] += 1
-            if created:
+            key = row_key(row)
+            image_path = os.path.join(options["image_basedir"], row["image_filename"])
+            checksum, image_error = row_checksum(row, image_path)
+            name_slug = slugify(row["name"])
+            book = books.get(key) or books.pop(name_slug, None) or legacy_books.pop(name_slug, None)
+            if (book and book.import_key == key and book.import_checksum == checksum
+                    and not options["force"]):
+                c["books_unchanged"] += 1
+                continue
+            if book is None:
+                book = models.Book()
                 c["books_created"] += 1
-        self.stdout.write("Books processed=%d (created=%d)" %
-                          (c["books"], c["books_created"]))
-        self.stdout.write("Tags processed=%d (created=%d)" %
-                          (c["tags"], c["tags_created"]))
-        self.stdout.write("Images processed=%d" % c["images"])
+            else:
+                c["books_updated"] += 1
+            # The checksum is stored by store_images() once the image is in
+            fill_book(book, row, book.import_checksum, slugs.__contains__)
+            slugs.add(book.slug)
+            books[key] = changed_books[key] = book
+            if image_error:
+                self.image_failed(row, image_error, c)
+                image_path = None
+            changed.append((row, book, image_path, checksum))
+        if not changed:
+            return []
+
+        # Image work is handed to the pool before the database writes of
+        # the batch, so that both run at the same time
+        known_images = {}
+        for book_id, image_hash in models.BookImage.objects.filter(
+                book_id__in=[book.id for book in changed_books.values() if book.pk],
+                ).values_list("book_id", "image_hash"):
+            known_images.setdefault(book_id, set()).add(image_hash)
+        upload_dirs = (
+            models.BookImage._meta.get_field("image").upload_to,
+            models.BookImage._meta.get_field("thumbnail").upload_to,
+            models.BookImageDerivative._meta.get_field("file").upload_to)
+        jobs = [
+            (row, book, checksum, known_images, pool.submit(
+                thumbnails.ingest_image, image_path, known_images.get(book.id, set()),
+                upload_dirs, settings.THUMBNAIL_SIZE,
+                settings.BOOK_IMAGE_DERIVATIVE_SIZES, settings.BOOK_IMAGE_DERIVATIVE_FORMATS))
+            for row, book, image_path, checksum in changed if image_path]
+
+        new_tags = {}
+        for row, book, image_path, checksum in changed:
+            for import_tag in row_tags(row):
+                if import_tag not in tags and import_tag not in new_tags:
+                    new_tags[import_tag] = models.BookTag(
+                        name=import_tag, slug=slugify(import_tag))
+        models.BookTag.objects.bulk_create(new_tags.values())
+        tags.update(new_tags)
+        c["tags_created"] += len(new_tags)
+
+        new_books = [book for book in changed_books.values() if book.pk is None]
+        updated_books = [book for book in changed_books.values() if book.pk is not None]
+        now = timezone.now()
+        for book in updated_books:
+            book.date_updated = now
+        models.Book.objects.bulk_create(new_books)
+        models.Book.objects.bulk_update(updated_books, [
+            "name", "price", "description", "slug", "import_key", "import_checksum",
+            "date_updated"])
+
+        # Tag links go straight into the through table, replacing those of
+        # the updated books
+        BookTags = models.Book.tags.through
+        if updated_books:
+            BookTags.objects.filter(book_id__in=[book.id for book in updated_books]).delete()
+        links = []
+        for row, book, image_path, checksum in changed:
+            for import_tag in row_tags(row):
+                links.append(BookTags(book_id=book.id, booktag_id=tags[import_tag].id))
+                c["tags"] += 1
+        BookTags.objects.bulk_create(links, ignore_conflicts=True)
+        # Bulk writes skip the signals which keep the search index in sync
+        search.get_backend().index_books([book.id for book in changed_books.values()])
+        return jobs
+
+    def store_images(self, jobs, c):
+        '''Writes the images of a batch and the checksums of their books'''
+        images = []
+        derivatives = []
+        imported = []
+        replaced = set()
+        for row, book, checksum, known_images, job in jobs:
+            try:
+                image_hash, stored = job.result()
+            except Exception as e:
+                # The old checksum stays, the row is tried again next time
+                self.image_failed(row, e, c)
+                continue
+            book.import_checksum = checksum
+            imported.append(book)
+            # Skipped because the book already has this image
+            if stored is None:
+                continue
+            # The same image appeared twice for a book within the batch
+            if image_hash in known_images.get(book.id, ()):
+                for name in [stored["image"], stored["thumbnail"]] + [d[-1] for d in stored["derivatives"]]:
+                    default_storage.delete(name)
+                continue
+            # The feed has one image per book, a new one replaces the old
+            if known_images.get(book.id):
+                replaced.add(book.id)
+            known_images.setdefault(book.id, set()).add(image_hash)
+            image = models.BookImage(
+                book=book, image=stored["image"], thumbnail=stored["thumbnail"],
+                image_hash=image_hash, thumbnail_status=models.BookImage.READY)
+            images.append(image)
+            derivatives.extend(
+                models.BookImageDerivative(
+                    book_image=image, size=size, format=image_format,
+                    width=width, height=height, file=name)
+                for size, image_format, width, height, name in stored["derivatives"])
+        if replaced:
+            delete_images(models.BookImage.objects.filter(book_id__in=replaced))
+        models.BookImage.objects.bulk_create(images)
+        models.BookImageDerivative.objects.bulk_create(derivatives)
+        models.Book.objects.bulk_update(imported, ["import_checksum"])
+        c["images"] += len(images)
@@ -0,0 +1,80 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main import models, thumbnails
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Render pending book thumbnails and derivatives in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument(
+            "--interval", type=float, default=5.0,
+            help="Seconds to wait before polling an empty queue again")
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Exit as soon as the queue is empty")
+
+    def handle(self, *args, **options):
+        with ProcessPoolExecutor(max_workers=options["workers"]) as pool:
+            while True:
+                processed = self.process_batch(pool, options["batch_size"])
+                if processed:
+                    continue
+                if options["once"]:
+                    break
+                time.sleep(options["interval"])
+
+    def process_batch(self, pool, batch_size):
+        images = list(
+            models.BookImage.objects.filter(thumbnail_status=models.BookImage.PENDING)
+            .order_by("id")[:batch_size])
+        futures = []
+        for image in images:
+            try:
+                futures.append((image, pool.submit(
+                    thumbnails.render_all,
+                    thumbnails.read_file(image.image),
+                    settings.THUMBNAIL_SIZE,
+                    settings.BOOK_IMAGE_DERIVATIVE_SIZES,
+                    settings.BOOK_IMAGE_DERIVATIVE_FORMATS)))
+            except OSError:
+                logger.exception("Cannot read image %d", image.id)
+                self.mark_failed(image)
+        for image, future in futures:
+            try:
+                data, derivatives = future.result()
+            except Exception:
+                logger.exception("Cannot render thumbnail for image %d", image.id)
+                self.mark_failed(image)
+                continue
+            image.thumbnail.save(image.image.name, ContentFile(data), save=False)
+            with transaction.atomic():
+                # The image may have been replaced while its thumbnail was rendering,
+                # in which case the row is pending again and the files are stale
+                stored = models.BookImage.objects.filter(
+                    id=image.id, image_hash=image.image_hash,
+                    thumbnail_status=models.BookImage.PENDING,
+                    ).update(thumbnail=image.thumbnail.name, thumbnail_status=models.BookImage.READY)
+                if stored:
+                    image.replace_derivatives(derivatives)
+            if not stored:
+                image.thumbnail.delete(save=False)
+        if images:
+            self.stdout.write("Thumbnails processed=%d" % len(images))
+        return len(images)
+
+    def mark_failed(self, image):
+        models.BookImage.objects.filter(
+            id=image.id, image_hash=image.image_hash,
+            thumbnail_status=models.BookImage.PENDING,
+            ).update(thumbnail_status=models.BookImage.FAILED)
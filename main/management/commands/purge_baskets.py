@@ -0,0 +1,50 @@
+import logging
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from main import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Delete the open anonymous baskets left untouched for a while"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=30, help="Age in days of the last change of a stale basket")
+        parser.add_argument("--batch-size", type=int, default=500, help="Baskets deleted per transaction")
+        parser.add_argument(
+            "--pause", type=float, default=0.5,
+            help="Seconds to sleep between batches, leaving the database to live traffic")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the stale baskets")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        stale = models.Basket.objects.filter(
+            status=models.Basket.OPEN, user__isnull=True, date_updated__lt=cutoff)
+        if options["dry_run"]:
+            self.stdout.write("Stale baskets=%d" % stale.count())
+            return
+
+        start = time.perf_counter()
+        baskets = lines = 0
+        while True:
+            ids = list(stale.order_by("id").values_list("id", flat=True)[:options["batch_size"]])
+            if not ids:
+                break
+            # The filter is applied again, a basket changed since the ids
+            # were read is kept. Each delete runs in its own short transaction.
+            deleted, per_model = stale.filter(id__in=ids).delete()
+            baskets += per_model.get("main.Basket", 0)
+            lines += per_model.get("main.BasketLine", 0)
+            logger.info("Purged baskets=%d up to id %d", per_model.get("main.Basket", 0), ids[-1])
+            if len(ids) < options["batch_size"]:
+                break
+            time.sleep(options["pause"])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            "Baskets deleted=%d, lines deleted=%d in %.1fs (%.0f rows/s)"
+            % (baskets, lines, elapsed, (baskets + lines) / elapsed if elapsed else 0))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main import search
+
+
+class Command(BaseCommand):
+    help = 'Recreate the catalog search index from the books in the database'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            indexed = search.get_backend().rebuild()
+        self.stdout.write("Books indexed=%d" % indexed)
@@ -0,0 +1,111 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from main import models, thumbnails
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the thumbnails of every book image in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument("--chunk-size", type=int, default=200)
+        parser.add_argument(
+            "--checkpoint", type=str, default=".regenerate_thumbnails",
+            help="File recording the last finished image id, used to resume")
+        parser.add_argument(
+            "--restart", action="store_true",
+            help="Ignore the checkpoint and start from the first image")
+
+    def handle(self, *args, **options):
+        checkpoint = options["checkpoint"]
+        last_id = 0
+        if not options["restart"] and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last_id = int(f.read())
+            self.stdout.write("Resuming after image id=%d" % last_id)
+        images = (
+            models.BookImage.objects.exclude(thumbnail_status=models.BookImage.PENDING)
+            .only("id", "book", "image", "image_hash", "thumbnail", "thumbnail_status").order_by("id"))
+        c = 0
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=options["workers"]) as pool:
+            chunk = self.render_chunk(pool, images.filter(id__gt=last_id)[:options["chunk_size"]])
+            while chunk:
+                last_id = chunk[-1][0].id
+                # Workers render the next chunk while this one is written out
+                next_chunk = self.render_chunk(pool, images.filter(id__gt=last_id)[:options["chunk_size"]])
+                c += self.store_chunk(chunk)
+                with open(checkpoint, "w") as f:
+                    f.write(str(last_id))
+                chunk = next_chunk
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        elapsed = time.perf_counter() - start
+        self.stdout.write("Thumbnails regenerated=%d in %.1fs (%.1f images/sec)" % (
+            c, elapsed, c / elapsed if elapsed else 0))
+
+    def render_chunk(self, pool, images):
+        chunk = []
+        for image in images:
+            try:
+                data = thumbnails.read_file(image.image)
+            except OSError:
+                logger.exception("Cannot read image %d", image.id)
+                chunk.append((image, None))
+                continue
+            chunk.append((image, pool.submit(
+                thumbnails.render_thumbnail, data, settings.THUMBNAIL_SIZE)))
+        return chunk
+
+    def store_chunk(self, chunk):
+        storage = models.BookImage._meta.get_field("thumbnail").storage
+        read = {image.id: (image.image_hash, image.thumbnail_status) for image, future in chunk}
+        rendered = []
+        failed = []
+        old_files = {}
+        for image, future in chunk:
+            try:
+                data = future.result() if future else None
+            except Exception:
+                logger.exception("Cannot render thumbnail for image %d", image.id)
+                data = None
+            if data is None:
+                image.thumbnail_status = models.BookImage.FAILED
+                failed.append(image)
+                continue
+            old_files[image.id] = image.thumbnail.name
+            image.thumbnail.save(image.image.name, ContentFile(data), save=False)
+            image.thumbnail_status = models.BookImage.READY
+            rendered.append(image)
+        with transaction.atomic():
+            # The image may have been replaced since it was read, in which
+            # case its row is pending again with a new hash and is left to
+            # process_thumbnails. The rows are locked from the check to the
+            # bulk update.
+            unchanged = {
+                image_id for image_id, image_hash, status in models.BookImage.objects
+                .select_for_update().filter(id__in=read)
+                .values_list("id", "image_hash", "thumbnail_status")
+                if read[image_id] == (image_hash, status)}
+            models.BookImage.objects.bulk_update(
+                [image for image in failed if image.id in unchanged], ["thumbnail_status"])
+            models.BookImage.objects.bulk_update(
+                [image for image in rendered if image.id in unchanged],
+                ["thumbnail", "thumbnail_status"])
+        models.Book.objects.touch({image.book_id for image in rendered if image.id in unchanged})
+        # Old files go only once the rows point at the new ones, the new
+        # files of replaced images are not referenced at all
+        for image in rendered:
+            if image.id not in unchanged:
+                storage.delete(image.thumbnail.name)
+            elif old_files[image.id]:
+                storage.delete(old_files[image.id])
+        return sum(1 for image in rendered if image.id in unchanged)
@@ -1,15 +1,69 @@
+import time
+from django.utils.functional import SimpleLazyObject
 from . import models
 
+# Seconds the header badge may lag behind changes made outside the views
+# which update the basket, like the admin
+BASKET_SUMMARY_TIMEOUT = 60
+
+
+def get_basket(request):
+    '''The basket of the session, forgetting it if it was deleted'''
+    basket_id = request.session.get("basket_id")
+    if basket_id is None:
+        return None
+    basket = models.Basket.objects.filter(id=basket_id).first()
+    if basket is None:
+        forget_basket(request)
+    return basket
+
+
+def create_basket(request):
+    '''A new basket for the session, owned by the user if logged in'''
+    user = request.user if request.user.is_authenticated else None
+    basket = models.Basket.objects.create(user=user)
+    request.session["basket_id"] = basket.id
+    request.basket = basket
+    return basket
+
+
+def forget_basket(request):
+    request.session.pop("basket_id", None)
+    forget_basket_summary(request)
+
+
+def basket_summary(request):
+    '''
+    {"lines": n, "count": n} of the session's basket, or None without one.
+    Kept in the session for BASKET_SUMMARY_TIMEOUT seconds, views changing
+    the basket call forget_basket_summary()
+    '''
+    basket_id = request.session.get("basket_id")
+    if basket_id is None:
+        return None
+    summary = request.session.get("basket_summary")
+    if summary and summary["basket_id"] == basket_id and summary["expires"] > time.time():
+        return summary
+    totals = models.Basket.objects.filter(id=basket_id).with_totals().values(
+        "line_count", "item_count").first()
+    if totals is None:
+        forget_basket(request)
+        return None
+    summary = {
+        "basket_id": basket_id, "lines": totals["line_count"], "count": totals["item_count"],
+        "expires": time.time() + BASKET_SUMMARY_TIMEOUT}
+    request.session["basket_summary"] = summary
+    return summary
+
+
+def forget_basket_summary(request):
+    request.session.pop("basket_summary", None)
+
+
 def basket_middleware(get_response):
     def middleware(request):
-        if 'basket_id' in request.session:
-            basket_id = request.session['basket_id']
-            basket = models.Basket.objects.get(id=basket_id)
-            request.basket = basket
-            
-        else:
-            request.basket=None
-            
+        # Loaded on first use only, most requests never need the basket
+        request.basket = SimpleLazyObject(lambda: get_basket(request))
         response = get_response(request)
         return response
-    return middleware
\ No newline at end of file
+    return middleware
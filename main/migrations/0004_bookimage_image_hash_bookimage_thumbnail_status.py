@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 17:42
+
+from django.db import migrations, models
+
+
+def mark_existing_thumbnails_ready(apps, schema_editor):
+    BookImage = apps.get_model("main", "BookImage")
+    BookImage.objects.exclude(thumbnail="").exclude(thumbnail=None).update(thumbnail_status=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_order_last_spoken_to_alter_orderline_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bookimage',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='bookimage',
+            name='thumbnail_status',
+            field=models.IntegerField(choices=[(0, 'Pending'), (1, 'Ready'), (2, 'Failed')], db_index=True, default=0),
+        ),
+        migrations.RunPython(mark_existing_thumbnails_ready, migrations.RunPython.noop),
+    ]
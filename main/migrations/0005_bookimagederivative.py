@@ -0,0 +1,29 @@
+# Generated by Django 4.1.13 on 2026-10-18 17:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_bookimage_image_hash_bookimage_thumbnail_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookImageDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.CharField(max_length=16)),
+                ('format', models.CharField(choices=[('webp', 'WebP'), ('jpeg', 'JPEG')], max_length=4)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('file', models.ImageField(upload_to='book-derivatives')),
+                ('book_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='main.bookimage')),
+            ],
+            options={
+                'unique_together': {('book_image', 'size', 'format')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.13 on 2026-10-18 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_bookimagederivative'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='import_checksum',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='import_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.13 on 2026-10-18 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_book_import_checksum_book_import_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['name', 'id'], name='main_book_name_2b9264_idx'),
+        ),
+    ]
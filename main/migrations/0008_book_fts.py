@@ -0,0 +1,39 @@
+# Generated by Django 4.1.13 on 2026-10-18 18:20
+
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    # The FTS5 index only exists on SQLite, other databases use another
+    # SEARCH_BACKEND
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS main_book_fts USING fts5("
+        "name, description, tags, tokenize = 'unicode61 remove_diacritics 2')")
+    schema_editor.execute('''
+        INSERT INTO main_book_fts (rowid, name, description, tags)
+        SELECT b.id, b.name, b.description, COALESCE((
+            SELECT group_concat(t.name, ' ')
+            FROM main_booktag t
+            JOIN main_book_tags bt ON bt.booktag_id = t.id
+            WHERE bt.book_id = b.id), '')
+        FROM main_book b
+        ''')
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS main_book_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_book_main_book_name_2b9264_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
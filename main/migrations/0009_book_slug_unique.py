@@ -0,0 +1,43 @@
+# Generated by Django 4.1.13 on 2026-10-18 17:59
+
+from django.db import migrations, models
+
+
+def deduplicate_slugs(apps, schema_editor):
+    # The oldest book keeps a shared (or empty) slug, the others get a
+    # numbered one, e.g. "emma-2"
+    Book = apps.get_model("main", "Book")
+    taken = set(Book.objects.values_list("slug", flat=True))
+    duplicates = (
+        Book.objects.values("slug").annotate(books=models.Count("id"))
+        .filter(books__gt=1).values_list("slug", flat=True))
+    renamed = []
+    for slug in duplicates:
+        for book in Book.objects.filter(slug=slug).order_by("id")[1:]:
+            base = slug or "book"
+            n = 1
+            candidate = base
+            while candidate in taken:
+                n += 1
+                suffix = "-%d" % n
+                candidate = base[:50 - len(suffix)] + suffix
+            taken.add(candidate)
+            book.slug = candidate
+            renamed.append(book)
+    Book.objects.bulk_update(renamed, ["slug"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_book_fts'),
+    ]
+
+    operations = [
+        migrations.RunPython(deduplicate_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='book',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+    ]
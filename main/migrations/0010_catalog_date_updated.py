@@ -0,0 +1,23 @@
+# Generated by Django 4.1.13 on 2026-10-18 18:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_book_slug_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booktag',
+            name='date_updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='date_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
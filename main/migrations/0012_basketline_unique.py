@@ -0,0 +1,33 @@
+# Generated by Django 4.1.13 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # The first line of a book in a basket gets the quantities of the
+    # others, which are deleted
+    BasketLine = apps.get_model("main", "BasketLine")
+    duplicates = (
+        BasketLine.objects.values("basket_id", "book_id")
+        .annotate(lines=models.Count("id"), first=models.Min("id"), total=models.Sum("quantity"))
+        .filter(lines__gt=1))
+    for duplicate in duplicates:
+        BasketLine.objects.filter(id=duplicate["first"]).update(quantity=duplicate["total"])
+        BasketLine.objects.filter(
+            basket_id=duplicate["basket_id"], book_id=duplicate["book_id"]
+        ).exclude(id=duplicate["first"]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_bookrecommendation'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='basketline',
+            unique_together={('basket', 'book')},
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.1.13 on 2026-10-18 18:40
+
+import datetime
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.utils.timezone
+
+# Older than any purge_baskets cutoff
+NO_ACTIVITY = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def backfill_date_updated(apps, schema_editor):
+    # Lines carry no timestamp, so the last order of the basket's user is the
+    # latest known activity. The rest count as stale rather than as touched
+    # when the migration ran
+    Basket = apps.get_model("main", "Basket")
+    Order = apps.get_model("main", "Order")
+    last_order = Order.objects.filter(
+        user=OuterRef("user")).order_by("-date_updated").values("date_updated")[:1]
+    Basket.objects.update(date_updated=Coalesce(
+        Subquery(last_order), models.Value(NO_ACTIVITY, output_field=models.DateTimeField())))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_basketline_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basket',
+            name='date_updated',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_date_updated, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.1.13 on 2026-10-18 18:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_basket_date_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('county', models.CharField(max_length=3)),
+                ('orders', models.PositiveIntegerField()),
+                ('lines', models.PositiveIntegerField()),
+                ('revenue', models.DecimalField(decimal_places=2, max_digits=12)),
+            ],
+            options={
+                'unique_together': {('day', 'county')},
+            },
+        ),
+        migrations.CreateModel(
+            name='BookOrderRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('county', models.CharField(max_length=3)),
+                ('lines', models.PositiveIntegerField()),
+                ('revenue', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='main.book')),
+            ],
+            options={
+                'unique_together': {('day', 'county', 'book')},
+            },
+        ),
+    ]
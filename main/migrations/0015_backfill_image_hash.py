@@ -0,0 +1,37 @@
+# Generated by Django 4.1.13 on 2026-10-18 19:20
+
+import hashlib
+import logging
+from django.db import migrations
+
+logger = logging.getLogger(__name__)
+
+
+def backfill_image_hash(apps, schema_editor):
+    # Images stored before 0004 have no hash, which import_data needs to
+    # recognise them when the catalog is imported again
+    BookImage = apps.get_model("main", "BookImage")
+    hashed = []
+    for image in BookImage.objects.filter(image_hash="").exclude(image="").iterator(chunk_size=500):
+        digest = hashlib.sha256()
+        try:
+            with image.image.open("rb") as f:
+                for chunk in f.chunks():
+                    digest.update(chunk)
+        except OSError:
+            logger.warning("Cannot read image %d, left without a hash", image.id)
+            continue
+        image.image_hash = digest.hexdigest()
+        hashed.append(image)
+    BookImage.objects.bulk_update(hashed, ["image_hash"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_order_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_image_hash, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,15 @@
 
 from django.contrib.auth.models import AbstractUser, BaseUserManager
+import collections
+import datetime
 import logging
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce, TruncDate
+import os.path
+from django.core.files.base import ContentFile
 from django.core.validators import MinValueValidator
+from django.utils import timezone
+from . import catalog_cache, exceptions
 
 logger= logging.getLogger(__name__)
 
@@ -74,6 +81,7 @@ class BookTag(models.Model):
     slug = models.SlugField(max_length=48)
     description = models.TextField(blank=True)
     active = models.BooleanField(default=True)
+    date_updated = models.DateTimeField(auto_now=True)
 
     objects = BookTagMananager()
 
@@ -92,6 +100,15 @@ class BookManager(models.Manager):
     def active(self):
         return self.filter(active=True)
 
+    def touch(self, ids):
+        '''
+        Marks books as changed for changes that don't save them, like
+        tagging or new images, so that their pages get new validators and
+        the cached ones are dropped
+        '''
+        transaction.on_commit(catalog_cache.invalidate)
+        return self.filter(id__in=ids).update(date_updated=timezone.now())
+
 
 class Book(models.Model):
     '''Details of a particular book'''
@@ -99,22 +116,85 @@ class Book(models.Model):
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=6, decimal_places=2)
     tags = models.ManyToManyField(BookTag, blank=True)
-    slug = models.SlugField(max_length=50)
+    slug = models.SlugField(max_length=50, unique=True)
     active = models.BooleanField(default=True)
     in_stock = models.BooleanField(default=True)
-    date_updated = models.DateTimeField(auto_now=True)
+    # Validates cached catalog pages, see main.views.ConditionalCatalogMixin
+    date_updated = models.DateTimeField(auto_now=True, db_index=True)
+    # Set by import_data: the book's identifier in the supplier feed and a
+    # checksum of the row it was last imported from
+    import_key = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
+    import_checksum = models.CharField(max_length=64, blank=True, editable=False)
 
     objects = BookManager()
 
+    class Meta:
+        # Serves the keyset pagination of the book list
+        indexes = [models.Index(fields=["name", "id"])]
+
     def __str__(self):
         return self.name
 
 
 class BookImage(models.Model):
     '''Handles image(s) for a particular book/books'''
+    PENDING = 0
+    READY = 1
+    FAILED = 2
+    THUMBNAIL_STATUSES = ((PENDING, "Pending"), (READY, "Ready"), (FAILED, "Failed"))
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     image = models.ImageField(upload_to='book-images')
     thumbnail = models.ImageField(upload_to='book-thumbnails', null=True)
+    # Thumbnails are rendered by the process_thumbnails command, the hash
+    # tells it (and the pre_save signal) whether the image really changed
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
+    thumbnail_status = models.IntegerField(choices=THUMBNAIL_STATUSES, default=PENDING, db_index=True)
+
+    def replace_derivatives(self, derivatives):
+        '''Stores (size, format, width, height, bytes) renditions in place of the current ones'''
+        for old in self.derivatives.all():
+            old.file.delete(save=False)
+        self.derivatives.all().delete()
+        new = []
+        for size, image_format, width, height, data in derivatives:
+            derivative = BookImageDerivative(
+                book_image=self, size=size, format=image_format, width=width, height=height)
+            name = "%s-%s.%s" % (
+                os.path.splitext(os.path.basename(self.image.name))[0], size, image_format)
+            derivative.file.save(name, ContentFile(data), save=False)
+            new.append(derivative)
+        BookImageDerivative.objects.bulk_create(new)
+        Book.objects.touch([self.book_id])
+
+
+class BookImageDerivative(models.Model):
+    '''A resized copy of a BookImage, see BOOK_IMAGE_DERIVATIVE_SIZES'''
+    FORMATS = (("webp", "WebP"), ("jpeg", "JPEG"))
+    book_image = models.ForeignKey(BookImage, on_delete=models.CASCADE, related_name="derivatives")
+    size = models.CharField(max_length=16)
+    format = models.CharField(max_length=4, choices=FORMATS)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    file = models.ImageField(upload_to="book-derivatives")
+
+    class Meta:
+        unique_together = ("book_image", "size", "format")
+
+
+class BookRecommendation(models.Model):
+    '''
+    One of the books most often bought together with a book, written by
+    the build_recommendations command
+    '''
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="recommendations")
+    recommended = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="+")
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        # Also the index the book page reads its recommendations with
+        unique_together = ("book", "rank")
+        ordering = ("book", "rank")
 
 
 class Address(models.Model):
@@ -133,30 +213,114 @@ class Address(models.Model):
     
     def __str__(self):
         return ",".join([self.name,self.address,self.town,self.county,])
-        
+
+
+class BasketQuerySet(models.QuerySet):
+    def with_totals(self):
+        '''
+        Annotates each basket with its line_count, item_count and
+        total_price, computed in SQL along with the baskets
+        '''
+        return self.annotate(
+            line_count=models.Count("basketline"),
+            item_count=Coalesce(models.Sum("basketline__quantity"), 0),
+            total_price=Coalesce(
+                models.Sum(
+                    models.F("basketline__quantity") * models.F("basketline__book__price"),
+                    output_field=models.DecimalField(max_digits=10, decimal_places=2)),
+                models.Value(0, output_field=models.DecimalField(max_digits=10, decimal_places=2))),
+            )
+
+
 class Basket(models.Model):
     OPEN = 0
     SUBMITTED = 1
     STATUSES = ((OPEN, "Open"),(SUBMITTED, "Submitted"))
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True)
     status = models.IntegerField(choices=STATUSES, default=OPEN)
-    
+    # Bumped by every change to the lines, purge_baskets deletes the open
+    # baskets left untouched for too long
+    date_updated = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = BasketQuerySet.as_manager()
+
+    def totals(self):
+        '''
+        {"line_count", "item_count", "total_price"}, from the annotations
+        of Basket.objects.with_totals() or else from a single query
+        '''
+        if not hasattr(self, "item_count"):
+            return Basket.objects.filter(id=self.id).with_totals().values(
+                "line_count", "item_count", "total_price").get()
+        return {
+            "line_count": self.line_count,
+            "item_count": self.item_count,
+            "total_price": self.total_price}
+
     def is_empty(self):
-        return self.basketline_set.all().count() == 0
+        return self.totals()["line_count"] == 0
     
     def count(self):
-        return sum(i.quantity for i in self.basketline_set.all())
+        return self.totals()["item_count"]
+
+    def touch(self):
+        Basket.objects.filter(id=self.id).update(date_updated=timezone.now())
+
+    def add(self, book, quantity=1):
+        '''
+        Adds quantity copies of book. The increment happens in the UPDATE
+        itself, so concurrent adds all count.
+        '''
+        self.touch()
+        lines = BasketLine.objects.filter(basket=self, book=book)
+        if lines.update(quantity=models.F("quantity") + quantity):
+            return
+        try:
+            with transaction.atomic():
+                BasketLine.objects.create(basket=self, book=book, quantity=quantity)
+        except IntegrityError:
+            # Another request created the line in the meantime
+            lines.update(quantity=models.F("quantity") + quantity)
+
+    def set_quantity(self, book, quantity):
+        '''Sets the quantity of book, removing its line at 0'''
+        if quantity <= 0:
+            self.remove(book)
+            return
+        self.touch()
+        BasketLine.objects.update_or_create(
+            basket=self, book=book, defaults={"quantity": quantity})
+
+    def remove(self, book):
+        self.touch()
+        BasketLine.objects.filter(basket=self, book=book).delete()
+
+    def merge(self, other):
+        '''
+        Moves the lines of the other basket into this one and deletes it.
+        Quantities of books in both baskets are summed. A fixed number of
+        queries is run, whatever the size of the baskets.
+        '''
+        with transaction.atomic():
+            lines = BasketLine.objects.filter(basket=self)
+            other_lines = BasketLine.objects.filter(basket=other)
+            shared = other_lines.filter(book_id__in=lines.values("book_id"))
+            lines.filter(book_id__in=other_lines.values("book_id")).update(
+                quantity=models.F("quantity") + models.Subquery(
+                    other_lines.filter(book_id=models.OuterRef("book_id")).values("quantity")[:1]))
+            shared.delete()
+            other_lines.update(basket=self)
+            Basket.objects.filter(id=other.id).delete()
+            self.touch()
 
     def create_order(self, billing_address, shipping_address):
         if not self.user:
             raise exceptions.BasketException("Cannot create order without user")
-        # logger.info(
-        #     "Creating order for basket_id=%s",
-        #     "shipping_address_id=%s", 
-        #     "billing_address_id=%s",
-        #     self.id,
-        #     shipping_address.id,
-        #     billing_address.id)
+        logger.info(
+            "Creating order for basket_id=%d, shipping_address_id=%d, billing_address_id=%d",
+            self.id,
+            shipping_address.id,
+            billing_address.id)
         order_data = {
             "user":self.user,
             "billing_name": billing_address.name,
@@ -168,26 +332,53 @@ class Basket(models.Model):
             "shipping_town": shipping_address.town,
             "shipping_county": shipping_address.county,
             }
-        order = Order.objects.create(**order_data)
-        c=0
-        for line in self.basketline_set.all():
-            for item in range(line.quantity):
-                order_line_data = {
-                    "order": order,
-                    "book": line.book}
-                order_line = OrderLine.objects.create(**order_line_data)
-                c += 1
-                logger.info("*******************\nCreated order with id=%s and lines_count=%s\n******************",order.id,c,)
+        with transaction.atomic():
+            # Claiming the basket with a conditional UPDATE locks its row until
+            # the transaction ends, so a double submitted checkout finds it
+            # already submitted instead of creating a second order.
+            claimed = Basket.objects.filter(id=self.id, status=Basket.OPEN).update(status=Basket.SUBMITTED)
+            if not claimed:
+                raise exceptions.BasketException("Basket %d has already been submitted" % self.id)
+            # The order and its lines go into the rollups together, not
+            # through post_save
+            order = Order(**order_data)
+            order._skip_rollup = True
+            order.save()
+            basket_lines = list(self.basketline_set.values_list("book_id", "quantity", "book__price"))
+            order_lines = [
+                OrderLine(order=order, book_id=book_id)
+                for book_id, quantity, price in basket_lines
+                for _ in range(quantity)]
+            OrderLine.objects.bulk_create(order_lines)
+            day, county = bucket = OrderRollup.objects.bucket(order)
+            OrderRollup.objects.add(orders={bucket: 1}, lines={
+                (day, county, book_id): [quantity, quantity * price]
+                for book_id, quantity, price in basket_lines})
         self.status = Basket.SUBMITTED
-        self.save()
+        logger.info("Created order with id=%d and lines_count=%d", order.id, len(order_lines))
         return order
     
 class BasketLine(models.Model):
     basket = models.ForeignKey(Basket, on_delete=models.CASCADE)
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
+
+    class Meta:
+        # A book has one line per basket, adding it again bumps the quantity
+        unique_together = ("basket", "book")
     
     
+class OrderQuerySet(models.QuerySet):
+    def mark_done_if_complete(self):
+        '''Marks as done, in a single UPDATE, the orders with no lines left to send'''
+        pending_lines = OrderLine.objects.filter(
+            order=models.OuterRef("pk"), status__lt=OrderLine.SENT)
+        return (
+            self.exclude(status=Order.DONE)
+            .filter(~models.Exists(pending_lines))
+            .update(status=Order.DONE, date_updated=timezone.now()))
+
+
 class Order(models.Model):
     NEW = 1
     PAID = 2
@@ -206,10 +397,35 @@ class Order(models.Model):
     date_updated = models.DateTimeField(auto_now=True)
     date_added = models.DateTimeField(auto_now_add=True)
     last_spoken_to = models.ForeignKey(User,null=True,related_name="cs_chats",on_delete=models.SET_NULL)
+
+    objects = OrderQuerySet.as_manager()
     
     def __str__(self):
         return f"Order no: { self.pk}"
 
+class OrderLineQuerySet(models.QuerySet):
+    def set_status(self, status):
+        '''
+        Moves every line in the queryset to ``status`` and propagates the
+        change to their orders with a fixed number of queries, however many
+        lines are involved. Unlike ``save()`` this does not send post_save.
+        '''
+        with transaction.atomic():
+            order_ids = list(self.order_by().values_list("order_id", flat=True).distinct())
+            # Only lines moving in or out of cancelled change the rollups
+            if status == OrderLine.CANCELLED:
+                OrderRollup.objects.add(
+                    lines=OrderRollup.objects.line_totals(self.exclude(status=status)), sign=-1)
+            else:
+                OrderRollup.objects.add(
+                    lines=OrderRollup.objects.line_totals(self.filter(status=OrderLine.CANCELLED)))
+            updated = self.update(status=status)
+            done = Order.objects.filter(id__in=order_ids).mark_done_if_complete()
+        logger.info(
+            "Moved %d order lines to status %d, %d orders marked as done", updated, status, done)
+        return updated
+
+
 class OrderLine(models.Model):
     NEW = 1
     PROCESSING = 2
@@ -218,4 +434,104 @@ class OrderLine(models.Model):
     STATUSES = ((NEW, "New"),(PROCESSING, "Processing"),(SENT, "Sent"),(CANCELLED, "Cancelled"),)
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="lines")
     book = models.ForeignKey(Book, on_delete=models.PROTECT)
-    status = models.IntegerField(choices=STATUSES, default=NEW)
\ No newline at end of file
+    status = models.IntegerField(choices=STATUSES, default=NEW)
+
+    objects = OrderLineQuerySet.as_manager()
+
+
+class OrderRollupManager(models.Manager):
+    def bucket(self, order):
+        return (timezone.localdate(order.date_added), order.shipping_county)
+
+    def line_totals(self, lines):
+        '''(day, county, book_id) -> [lines, revenue] of the given order lines'''
+        return {
+            (day, county, book_id): [count, revenue]
+            for day, county, book_id, count, revenue in lines
+            .annotate(day=TruncDate("order__date_added"))
+            .values_list("day", "order__shipping_county", "book_id")
+            .annotate(lines=models.Count("id"), revenue=models.Sum("book__price")).order_by()}
+
+    def add(self, orders=None, lines=None, sign=1):
+        '''
+        Adds to the rollups, once the transaction commits, ``orders`` mapping
+        (day, county) to a number of orders and ``lines`` mapping
+        (day, county, book_id) to [lines, revenue]. With ``sign=-1`` they are
+        taken off instead. Only the rows of these keys are updated, whatever
+        the number of orders already rolled up.
+        '''
+        totals = collections.defaultdict(lambda: [0, 0, 0])
+        for bucket, count in (orders or {}).items():
+            totals[bucket][0] += sign * count
+        book_totals = {}
+        for (day, county, book_id), (count, revenue) in (lines or {}).items():
+            book_totals[day, county, book_id] = (sign * count, sign * revenue)
+            total = totals[day, county]
+            total[1] += sign * count
+            total[2] += sign * revenue
+        if totals:
+            transaction.on_commit(lambda: self._apply(totals, book_totals))
+
+    def _apply(self, totals, book_totals):
+        try:
+            with transaction.atomic():
+                for (day, county), (orders, lines, revenue) in totals.items():
+                    self._increment(
+                        self.model, {"day": day, "county": county},
+                        orders=orders, lines=lines, revenue=revenue)
+                for (day, county, book_id), (lines, revenue) in book_totals.items():
+                    self._increment(
+                        BookOrderRollup, {"day": day, "county": county, "book_id": book_id},
+                        lines=lines, revenue=revenue)
+        except IntegrityError:
+            logger.exception("Order rollups left stale, run backfill_order_rollups")
+            return
+        catalog_cache.invalidate_sales()
+
+    def _increment(self, model, keys, **changes):
+        # The increments are single UPDATEs, so concurrent checkouts of the
+        # same day and county add up instead of overwriting each other
+        rows = model.objects.filter(**keys)
+        increments = {field: models.F(field) + value for field, value in changes.items()}
+        if not rows.update(**increments):
+            try:
+                with transaction.atomic():
+                    model.objects.create(**keys, **changes)
+                return
+            except IntegrityError:
+                # Created by a concurrent transaction since the UPDATE
+                rows.update(**increments)
+        if any(value < 0 for value in changes.values()):
+            rows.filter(**{field: 0 for field in changes if field != "revenue"}).delete()
+
+
+class OrderRollup(models.Model):
+    '''
+    Orders, order lines and revenue of a day in a shipping county, for the
+    admin reports. Cancelled lines are left out and revenue is counted at
+    the book price. Kept up to date by the increments of
+    OrderRollup.objects.add() and rebuilt by the backfill_order_rollups
+    command.
+    '''
+    day = models.DateField()
+    county = models.CharField(max_length=3)
+    orders = models.PositiveIntegerField()
+    lines = models.PositiveIntegerField()
+    revenue = models.DecimalField(max_digits=12, decimal_places=2)
+
+    objects = OrderRollupManager()
+
+    class Meta:
+        unique_together = ("day", "county")
+
+
+class BookOrderRollup(models.Model):
+    '''The lines and revenue of a book in the orders of a day and county'''
+    day = models.DateField()
+    county = models.CharField(max_length=3)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name="+")
+    lines = models.PositiveIntegerField()
+    revenue = models.DecimalField(max_digits=12, decimal_places=2)
+
+    class Meta:
+        unique_together = ("day", "county", "book")
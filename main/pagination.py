@@ -0,0 +1,94 @@
+'''
+Keyset pagination: pages are found by filtering on the ordering columns
+of the last row seen instead of an OFFSET, so every page costs the same
+whatever its depth, and no COUNT(*) is needed.
+'''
+import base64
+import binascii
+import json
+from django.db.models import Q
+
+NEXT = "n"
+PREVIOUS = "p"
+
+
+def encode_cursor(direction, values):
+    return base64.urlsafe_b64encode(json.dumps([direction] + list(values)).encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''Returns (direction, values), or None for a missing or mangled cursor'''
+    try:
+        direction, *values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        return None
+    if direction not in (NEXT, PREVIOUS):
+        return None
+    return direction, values
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    '''
+    Paginates a queryset over ascending ``ordering`` fields, the last of
+    which must be unique so that every row has a distinct position.
+    '''
+    def __init__(self, queryset, per_page, ordering=("name", "id")):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = ordering
+
+    def after(self, values, reverse=False):
+        # (a, b) > (x, y) is a > x OR (a = x AND b > y), and so on for more fields
+        lookup = "lt" if reverse else "gt"
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            equal = {f: v for f, v in zip(self.ordering[:i], values)}
+            condition |= Q(**equal, **{"%s__%s" % (field, lookup): values[i]})
+        return condition
+
+    def page(self, cursor=None):
+        decoded = decode_cursor(cursor) if cursor else None
+        if decoded and len(decoded[1]) != len(self.ordering):
+            decoded = None
+        backwards = decoded is not None and decoded[0] == PREVIOUS
+        queryset = self.queryset
+        if decoded:
+            queryset = queryset.filter(self.after(decoded[1], reverse=backwards))
+        if backwards:
+            queryset = queryset.order_by(*["-%s" % field for field in self.ordering])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        # One extra row tells whether there is anything beyond this page
+        rows = list(queryset[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+        has_next = decoded is not None if backwards else more
+        has_previous = more if backwards else decoded is not None
+        return KeysetPage(
+            rows,
+            self.cursor(NEXT, rows[-1]) if rows and has_next else None,
+            self.cursor(PREVIOUS, rows[0]) if rows and has_previous else None)
+
+    def cursor(self, direction, row):
+        return encode_cursor(direction, [getattr(row, field) for field in self.ordering])
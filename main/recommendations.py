@@ -0,0 +1,52 @@
+'''
+Co-purchase recommendations, computed with sparse matrices.
+
+Orders and books form a binary orders x books matrix X. X.T @ X counts,
+for every pair of books, the orders containing both. Counts are
+normalized by the number of orders of each book (cosine similarity) so
+that bestsellers don't end up next to every book.
+'''
+import numpy as np
+from scipy import sparse
+
+
+def co_purchases(pairs, top_n=10, min_count=1, block_size=4096):
+    '''
+    Takes an (n, 2) array of (order id, book id) and returns four arrays:
+    book ids, recommended book ids, ranks (from 1) and scores, holding the
+    top_n neighbours of every book.
+
+    The product is computed for block_size books at a time, which bounds
+    memory use on large catalogs.
+    '''
+    empty = np.empty(0, dtype=np.int64)
+    if not len(pairs):
+        return empty, empty, empty, np.empty(0)
+    order_ids, order_index = np.unique(pairs[:, 0], return_inverse=True)
+    book_ids, book_index = np.unique(pairs[:, 1], return_inverse=True)
+    X = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32), (order_index.ravel(), book_index.ravel())),
+        shape=(len(order_ids), len(book_ids)))
+    # A book bought several times in an order counts once
+    X.sum_duplicates()
+    X.data[:] = 1
+    Xt = X.T.tocsr()
+    orders_per_book = np.asarray(X.sum(axis=0)).ravel()
+
+    results = []
+    for start in range(0, len(book_ids), block_size):
+        counts = (Xt[start:start + block_size] @ X).tocoo()
+        rows = counts.row.astype(np.int64) + start
+        cols = counts.col.astype(np.int64)
+        data = counts.data
+        keep = (rows != cols) & (data >= min_count)
+        rows, cols, data = rows[keep], cols[keep], data[keep]
+        scores = data / np.sqrt(orders_per_book[rows] * orders_per_book[cols])
+        # By book, best score first, ties broken by book id
+        order = np.lexsort((cols, -scores, rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        ranks = np.arange(len(rows)) - np.searchsorted(rows, rows, side="left")
+        keep = ranks < top_n
+        results.append((
+            book_ids[rows[keep]], book_ids[cols[keep]], ranks[keep] + 1, scores[keep]))
+    return tuple(np.concatenate(column) for column in zip(*results))
@@ -0,0 +1,189 @@
+'''
+Catalog search.
+
+The backend named by settings.SEARCH_BACKEND keeps a full-text index of
+each book's name, description and tag names. Signals keep it in sync with
+single saves, bulk writes (like import_data --bulk) call index_books()
+themselves and rebuild_search_index recreates it from scratch.
+'''
+import functools
+import re
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+from . import models
+
+# SQLite refuses statements with too many parameters, ids are sent in chunks
+CHUNK_SIZE = 500
+
+WORD_RE = re.compile(r"\w+")
+
+
+def chunks(ids, size=CHUNK_SIZE):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+class SearchBackend:
+    '''Interface of the search backends'''
+
+    def index_books(self, ids):
+        '''(Re)indexes the books with the given ids, deleted ones are dropped'''
+
+    def remove_books(self, ids):
+        '''Drops the books with the given ids from the index'''
+
+    def rebuild(self):
+        '''Recreates the whole index, returning the number of books indexed'''
+        return 0
+
+    def search(self, query, queryset):
+        '''
+        Returns the books of queryset matching query, best match first.
+        The result supports count() and slicing, so it can be paginated.
+        '''
+        raise NotImplementedError
+
+
+class SimpleSearchBackend(SearchBackend):
+    '''
+    Falls back on LIKE scans, without an index to maintain. Fine for small
+    catalogs and databases without a full-text engine.
+    '''
+
+    def search(self, query, queryset):
+        words = WORD_RE.findall(query)
+        if not words:
+            return queryset.none()
+        for word in words:
+            queryset = queryset.filter(
+                Q(name__icontains=word)
+                | Q(description__icontains=word)
+                | Q(tags__name__icontains=word))
+        return queryset.distinct().order_by("name", "id")
+
+
+class SQLiteFTSBackend(SearchBackend):
+    '''
+    Indexes books in an FTS5 table whose rowid is the book id. Results are
+    ranked with BM25, a match in the name weighs more than one in the tags,
+    which weighs more than one in the description.
+    '''
+    table = "main_book_fts"
+    weights = (10.0, 1.0, 5.0)
+
+    # The rows of the books selected by the WHERE clause appended to it
+    select_rows = '''
+        SELECT b.id, b.name, b.description, COALESCE((
+            SELECT group_concat(t.name, ' ')
+            FROM main_booktag t
+            JOIN main_book_tags bt ON bt.booktag_id = t.id
+            WHERE bt.book_id = b.id), '')
+        FROM main_book b
+        '''
+
+    def index_books(self, ids):
+        with connection.cursor() as cursor:
+            for chunk in chunks(ids):
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute(
+                    "DELETE FROM %s WHERE rowid IN (%s)" % (self.table, placeholders), chunk)
+                cursor.execute(
+                    "INSERT INTO %s (rowid, name, description, tags) %s WHERE b.id IN (%s)"
+                    % (self.table, self.select_rows, placeholders), chunk)
+
+    def remove_books(self, ids):
+        with connection.cursor() as cursor:
+            for chunk in chunks(ids):
+                cursor.execute(
+                    "DELETE FROM %s WHERE rowid IN (%s)"
+                    % (self.table, ", ".join(["%s"] * len(chunk))), chunk)
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s" % self.table)
+            cursor.execute(
+                "INSERT INTO %s (rowid, name, description, tags) %s"
+                % (self.table, self.select_rows))
+            cursor.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (self.table, self.table))
+            cursor.execute("SELECT count(*) FROM %s" % self.table)
+            return cursor.fetchone()[0]
+
+    def match_expression(self, query):
+        # User input is never passed as FTS5 syntax: every word is quoted
+        # and must be present, the last one may be incomplete
+        words = WORD_RE.findall(query)
+        if not words:
+            return None
+        terms = ['"%s"' % word for word in words]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(self, query, queryset):
+        match = self.match_expression(query)
+        if match is None:
+            return queryset.none()
+        return RankedResults(self, match, queryset)
+
+
+class RankedResults:
+    '''
+    Lazy FTS5 results. Only the ids of the requested slice are read from the
+    index, ranked and filtered in SQL, then their books are loaded from
+    queryset in one query.
+    '''
+
+    def __init__(self, backend, match, queryset):
+        self.backend = backend
+        self.match = match
+        self.queryset = queryset
+        self._count = None
+
+    def _execute(self, select, tail="", params=()):
+        # Only active books are listed, the flag is checked here since
+        # make_active/make_inactive change it without signals
+        sql = '''
+            SELECT %(select)s
+            FROM %(table)s f
+            JOIN main_book b ON b.id = f.rowid
+            WHERE f.%(table)s MATCH %%s AND b.active
+            %(tail)s
+            ''' % {"select": select, "table": self.backend.table, "tail": tail}
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [self.match, *params])
+            return cursor.fetchall()
+
+    def count(self):
+        if self._count is None:
+            self._count = self._execute("count(*)")[0][0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key:key + 1][0]
+        offset = key.start or 0
+        limit = -1 if key.stop is None else max(key.stop - offset, 0)
+        weights = ", ".join(str(weight) for weight in self.backend.weights)
+        rows = self._execute(
+            "f.rowid",
+            "ORDER BY bm25(f.%s, %s), f.rowid LIMIT %%s OFFSET %%s" % (self.backend.table, weights),
+            [limit, offset])
+        ids = [row[0] for row in rows]
+        books = self.queryset.in_bulk(ids)
+        return [books[id] for id in ids if id in books]
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend():
+    return import_string(settings.SEARCH_BACKEND)()
+
+
+def search(query, queryset=None):
+    if queryset is None:
+        queryset = models.Book.objects.active()
+    return get_backend().search(query, queryset)
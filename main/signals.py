@@ -1,53 +1,195 @@
-from io import BytesIO
 import logging
-from PIL import Image
-from django.core.files.base import ContentFile
-from django.db.models.signals import pre_save, post_save
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import (
+    post_init, pre_save, post_save, pre_delete, post_delete, m2m_changed)
 from django.dispatch import receiver
-from .models import BookImage,Basket,Order, OrderLine
+from .models import Book, BookTag, BookImage,Basket,Order, OrderLine, OrderRollup
 from django.contrib.auth.signals import user_logged_in
-
-THUMBNAIL_SIZE = (150, 150)
+from . import autocomplete, catalog_cache, middlewares, search, thumbnails
 
 logger = logging.getLogger(__name__)
 
 
 @receiver(pre_save, sender=BookImage)
-def generate_thumbnail(sender, instance, **kwargs):
-    logger.info('Generating thumbnail for book %d', instance.book.id)
+def queue_thumbnail(sender, instance, **kwargs):
+    # The image was not replaced, so the thumbnail is still valid
+    if instance.image._committed:
+        return
+    image_hash = thumbnails.content_hash(instance.image)
+    if image_hash == instance.image_hash:
+        return
+    logger.info('Queueing thumbnail for book %d', instance.book_id)
+    instance.image_hash = image_hash
+    instance.thumbnail_status = BookImage.PENDING
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, **kwargs):
+    search.get_backend().index_books([instance.id])
+    # The in-memory index can't be rolled back, it follows committed data only
+    transaction.on_commit(lambda: autocomplete.refresh_book(instance))
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    search.get_backend().remove_books([instance.id])
+    transaction.on_commit(lambda: autocomplete.remove_books([instance.id]))
+
+@receiver(post_save, sender=BookImage)
+@receiver(post_delete, sender=BookImage)
+def touch_image_book(sender, instance, **kwargs):
+    Book.objects.touch([instance.book_id])
+
+@receiver(m2m_changed, sender=Book.tags.through)
+def book_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Tagging from the tag side, pk_set holds book ids except on clear
+    if reverse and action == "pre_clear":
+        instance._cleared_book_ids = list(instance.book_set.values_list("id", flat=True))
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        book_ids = [instance.id]
+    elif action == "post_clear":
+        book_ids = instance._cleared_book_ids
+    else:
+        book_ids = pk_set
+    search.get_backend().index_books(book_ids)
+    Book.objects.touch(book_ids)
+
+@receiver(post_save, sender=BookTag)
+def index_tagged_books(sender, instance, created, **kwargs):
+    # A renamed tag changes the indexed text of all its books
+    if not created:
+        search.get_backend().index_books(instance.book_set.values_list("id", flat=True))
+
+@receiver(pre_delete, sender=BookTag)
+def remember_tagged_books(sender, instance, **kwargs):
+    # The cascade removes the links without m2m_changed, the books are
+    # read while they still are linked
+    instance._tagged_book_ids = list(instance.book_set.values_list("id", flat=True))
 
-    image = Image.open(instance.image)
-    image = image.convert('RGB')
-    image.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
-    temp_thumb = BytesIO()
-    image.save(temp_thumb, 'JPEG')
-    temp_thumb.seek(0)
+@receiver(post_delete, sender=BookTag)
+def index_untagged_books(sender, instance, **kwargs):
+    book_ids = getattr(instance, "_tagged_book_ids", [])
+    if book_ids:
+        search.get_backend().index_books(book_ids)
+        Book.objects.touch(book_ids)
 
-    # save=False, because otherwise it will run in an infinite loop!
-    instance.thumbnail.save(instance.image.name, ContentFile(temp_thumb.read()), save=False)
-    temp_thumb.close()
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=BookTag)
+@receiver(post_delete, sender=BookTag)
+@receiver(post_save, sender=BookImage)
+@receiver(post_delete, sender=BookImage)
+@receiver(m2m_changed, sender=Book.tags.through)
+def invalidate_catalog_cache(sender, **kwargs):
+    # After the commit, so that no request caches pages from before it
+    transaction.on_commit(catalog_cache.invalidate)
 
 @receiver(user_logged_in)
 def merge_baskets_if_found(sender, user, request,**kwargs):
     anonymous_basket = getattr(request,"basket",None)
-    if anonymous_basket:
-        try:
-            logged_in_basket = Basket.objects.get(user=user, status=Basket.OPEN)
-            for line in anonymous_basket.basketline_set.all():
-                line.basket = logged_in_basket
-                line.save()
-                anonymous_basket.delete()
-                request.basket = logged_in_basket
-                logger.info("Merged basket to id %d", logged_in_basket.id)
-        except Basket.DoesNotExist:
+    if not anonymous_basket:
+        return
+    logged_in_basket = (
+        Basket.objects.filter(user=user, status=Basket.OPEN)
+        .exclude(id=anonymous_basket.id).order_by("id").first())
+    if logged_in_basket is None:
+        if anonymous_basket.user_id != user.id:
             anonymous_basket.user = user
             anonymous_basket.save()
             logger.info("Assigned user to basket id %d",anonymous_basket.id)
-            
+        return
+    logged_in_basket.merge(anonymous_basket)
+    request.basket = logged_in_basket
+    request.session["basket_id"] = logged_in_basket.id
+    middlewares.forget_basket_summary(request)
+    logger.info("Merged basket to id %d", logged_in_basket.id)
+
+
 @receiver(post_save, sender=OrderLine)
 def orderline_to_order_status(sender, instance, **kwargs):
-    if not instance.order.lines.filter(status__lt=OrderLine.SENT).exists():
+    # Only single line saves get here, bulk changes go through
+    # OrderLine.objects.set_status() which propagates the status itself
+    if Order.objects.filter(id=instance.order_id).mark_done_if_complete():
         logger.info(
-            "All lines for order %d have been processed.Marking as done.", instance.order.id,)
-        instance.order.status = Order.DONE
-        instance.order.save()
\ No newline at end of file
+            "All lines for order %d have been processed.Marking as done.", instance.order_id,)
+
+
+def rolled_up(state):
+    return state is not None and state[1] != OrderLine.CANCELLED
+
+
+@receiver(post_init, sender=OrderLine)
+def remember_order_line_state(sender, instance, **kwargs):
+    # The book and status the line was loaded with, to roll up only the
+    # difference when it is saved
+    instance._rollup_state = (instance.__dict__.get("book_id"), instance.__dict__.get("status"))
+
+
+@receiver(post_save, sender=OrderLine)
+def rollup_order_line(sender, instance, created, **kwargs):
+    old = None if created else instance._rollup_state
+    new = instance._rollup_state = (instance.book_id, instance.status)
+    if old is not None and None in old:
+        # Loaded without its book or status, which were not saved then
+        return
+    if rolled_up(old) == rolled_up(new) and (not rolled_up(new) or old[0] == new[0]):
+        return
+    day, county = OrderRollup.objects.bucket(instance.order)
+    prices = dict(Book.objects.filter(
+        id__in={state[0] for state in (old, new) if rolled_up(state)}).values_list("id", "price"))
+    if rolled_up(old):
+        OrderRollup.objects.add(lines={(day, county, old[0]): [1, prices[old[0]]]}, sign=-1)
+    if rolled_up(new):
+        OrderRollup.objects.add(lines={(day, county, new[0]): [1, prices[new[0]]]})
+
+
+@receiver(post_delete, sender=OrderLine)
+def rollup_deleted_order_line(sender, instance, origin=None, **kwargs):
+    # Lines deleted along with their order are taken off with the order
+    deleted_lines = isinstance(origin, OrderLine) or (
+        isinstance(origin, QuerySet) and origin.model is OrderLine)
+    if not deleted_lines or not rolled_up(instance._rollup_state):
+        return
+    day, county = OrderRollup.objects.bucket(instance.order)
+    OrderRollup.objects.add(
+        lines={(day, county, instance.book_id): [1, instance.book.price]}, sign=-1)
+
+
+@receiver(post_init, sender=Order)
+def remember_order_bucket(sender, instance, **kwargs):
+    # An order moved to another day or county leaves its old bucket stale.
+    # The bucket it was loaded with spares a query on every save
+    instance._rollup_bucket = None
+    if instance.__dict__.get("date_added") and "shipping_county" in instance.__dict__:
+        instance._rollup_bucket = OrderRollup.objects.bucket(instance)
+
+
+@receiver(post_save, sender=Order)
+def rollup_order(sender, instance, created, **kwargs):
+    old_bucket = instance._rollup_bucket
+    bucket = instance._rollup_bucket = OrderRollup.objects.bucket(instance)
+    if created:
+        # Basket.create_order rolls up the order along with its lines
+        if not getattr(instance, "_skip_rollup", False):
+            OrderRollup.objects.add(orders={bucket: 1})
+        return
+    if old_bucket is None or old_bucket == bucket:
+        return
+    lines = OrderRollup.objects.line_totals(
+        instance.lines.exclude(status=OrderLine.CANCELLED))
+    OrderRollup.objects.add(orders={old_bucket: 1}, lines={
+        (*old_bucket, book_id): totals for (day, county, book_id), totals in lines.items()}, sign=-1)
+    OrderRollup.objects.add(orders={bucket: 1}, lines=lines)
+
+
+@receiver(pre_delete, sender=Order)
+def remember_order_lines(sender, instance, **kwargs):
+    instance._rollup_lines = OrderRollup.objects.line_totals(
+        instance.lines.exclude(status=OrderLine.CANCELLED))
+
+
+@receiver(post_delete, sender=Order)
+def rollup_deleted_order(sender, instance, **kwargs):
+    OrderRollup.objects.add(
+        orders={OrderRollup.objects.bucket(instance): 1}, lines=instance._rollup_lines, sign=-1)
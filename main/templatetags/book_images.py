@@ -0,0 +1,46 @@
+from django import template
+from django.conf import settings
+from django.utils.html import format_html, format_html_join
+
+register = template.Library()
+
+
+def derivatives_in_format(book_image, image_format):
+    # Filtering in python lets the caller prefetch book_image.derivatives
+    return sorted(
+        (d for d in book_image.derivatives.all() if d.format == image_format),
+        key=lambda d: d.width)
+
+
+@register.simple_tag
+def book_image_srcset(book_image, image_format="jpeg"):
+    '''Returns a srcset attribute value listing every derivative in a format'''
+    return ", ".join(
+        "%s %dw" % (d.file.url, d.width)
+        for d in derivatives_in_format(book_image, image_format))
+
+
+@register.simple_tag
+def book_image_url(book_image, size="detail", image_format="jpeg"):
+    '''Returns the URL of one derivative, or of the original if it is not rendered yet'''
+    for d in derivatives_in_format(book_image, image_format):
+        if d.size == size:
+            return d.file.url
+    return book_image.image.url
+
+
+@register.simple_tag
+def book_image_picture(book_image, size="detail", sizes="100vw", alt=""):
+    '''Renders a <picture> serving WebP where supported and JPEG otherwise'''
+    sources = format_html_join(
+        "", '<source type="image/{}" srcset="{}" sizes="{}">',
+        ((image_format, book_image_srcset(book_image, image_format), sizes)
+         for image_format in settings.BOOK_IMAGE_DERIVATIVE_FORMATS
+         if image_format != "jpeg" and derivatives_in_format(book_image, image_format)))
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" alt="{}"></picture>',
+        sources,
+        book_image_url(book_image, size),
+        book_image_srcset(book_image, "jpeg"),
+        sizes,
+        alt)
@@ -1,16 +1,21 @@
 from time import sleep, time
 from unicodedata import name
 from django.test import TestCase
+from django.core.cache import cache
 from django.urls import reverse
+from django.utils import timezone
 from main import factories
-from main import models
+from main import models, autocomplete
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 from unittest.mock import patch
 
 
 class TestAdminViews(TestCase):
+    def setUp(self):
+        cache.clear()
+
     def test_most_bought_books(self):
         books = [
             factories.BookFactory(name='Book 1'),
@@ -19,13 +24,14 @@ class TestAdminViews(TestCase):
         ]
         user1 = models.User.objects.create_superuser(email="anonymous@gmail.com", password="Abcd_123")
         self.client.force_login(user1)
-        orders = factories.OrderFactory.create_batch(3, user=user1)
-        factories.OrderLineFactory.create_batch(2, order=orders[0], book=books[0])
-        factories.OrderLineFactory.create_batch(2, order=orders[0], book=books[1])
-        factories.OrderLineFactory.create_batch(2, order=orders[1], book=books[0])
-        factories.OrderLineFactory.create_batch(2, order=orders[1], book=books[2])
-        factories.OrderLineFactory.create_batch(1, order=orders[2], book=books[0])
-        factories.OrderLineFactory.create_batch(1, order=orders[2], book=books[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            orders = factories.OrderFactory.create_batch(3, user=user1)
+            factories.OrderLineFactory.create_batch(2, order=orders[0], book=books[0])
+            factories.OrderLineFactory.create_batch(2, order=orders[0], book=books[1])
+            factories.OrderLineFactory.create_batch(2, order=orders[1], book=books[0])
+            factories.OrderLineFactory.create_batch(2, order=orders[1], book=books[2])
+            factories.OrderLineFactory.create_batch(1, order=orders[2], book=books[0])
+            factories.OrderLineFactory.create_batch(1, order=orders[2], book=books[1])
     
         response = self.client.post(reverse("admin:most_bought_products"),{"period": "90"},)
         self.assertEqual(response.status_code, 200)
@@ -36,7 +42,111 @@ class TestAdminViews(TestCase):
         print(response.context["labels"])
         print(response.context["values"])
         self.assertEqual(data,  {"Book 2": 3, "Book 3": 2, "Book 1": 5})
+
+    def test_orders_per_day_reads_the_rollups(self):
+        user1 = models.User.objects.create_superuser(email="anonymous@gmail.com", password="Abcd_123")
+        self.client.force_login(user1)
+        with self.captureOnCommitCallbacks(execute=True):
+            factories.OrderFactory.create_batch(3, user=user1, shipping_county="nrb")
+            factories.OrderFactory(user=user1, shipping_county="ksm")
+        with self.assertNumQueries(3):
+            response = self.client.get("/admin/orders_per_day/")
+        self.assertEqual(response.context["labels"], [timezone.localdate().strftime("%Y-%m-%d")])
+        self.assertEqual(response.context["values"], [4])
+
+    def test_most_bought_books_are_ranked_limited_and_cached(self):
+        user1 = models.User.objects.create_superuser(email="anonymous@gmail.com", password="Abcd_123")
+        self.client.force_login(user1)
+        books = [factories.BookFactory(name="Book %d" % i) for i in range(5)]
+        with self.captureOnCommitCallbacks(execute=True):
+            order = factories.OrderFactory(user=user1)
+            for i, book in enumerate(books):
+                factories.OrderLineFactory.create_batch(i + 1, order=order, book=book)
+            old_order = factories.OrderFactory(user=user1)
+            factories.OrderLineFactory.create_batch(10, order=old_order, book=books[0])
+            old_order.date_added = timezone.now() - timedelta(days=45)
+            old_order.save()
+
+        response = self.client.post(
+            reverse("admin:most_bought_products"), {"period": "30", "limit": "3"})
+        self.assertEqual(response.context["labels"], ["Book 4", "Book 3", "Book 2"])
+        self.assertEqual(response.context["values"], [5, 4, 3])
+        response = self.client.post(
+            reverse("admin:most_bought_products"), {"period": "30", "days": "60", "limit": "1"})
+        self.assertEqual(response.context["labels"], ["Book 0"])
+        self.assertEqual(response.context["values"], [11])
+
+        # Served from the cache until the orders change
+        with self.assertNumQueries(2):
+            self.client.post(reverse("admin:most_bought_products"), {"days": "60", "limit": "1"})
+        with self.captureOnCommitCallbacks(execute=True):
+            factories.OrderLineFactory.create_batch(10, order=order, book=books[1])
+        response = self.client.post(
+            reverse("admin:most_bought_products"), {"days": "60", "limit": "1"})
+        self.assertEqual(response.context["labels"], ["Book 1"])
+
+    def test_order_inline_save_marks_order_done(self):
+        user1 = models.User.objects.create_superuser(email="anonymous@gmail.com", password="Abcd_123")
+        self.client.force_login(user1)
+        order = factories.OrderFactory(user=user1, status=models.Order.PAID)
+        lines = factories.OrderLineFactory.create_batch(
+            20, order=order, book=factories.BookFactory())
+        post_data = {
+            "user": user1.id,
+            "status": models.Order.PAID,
+            "billing_name": "Peter Evance",
+            "billing_address": "State House",
+            "billing_town": "Nairobi",
+            "billing_county": "nrb",
+            "shipping_name": "Peter Evance",
+            "shipping_address": "State House",
+            "shipping_town": "Nairobi",
+            "shipping_county": "nrb",
+            "lines-TOTAL_FORMS": len(lines),
+            "lines-INITIAL_FORMS": len(lines),
+            "lines-MIN_NUM_FORMS": 0,
+            "lines-MAX_NUM_FORMS": 1000,
+            }
+        for i, line in enumerate(lines):
+            post_data["lines-%d-id" % i] = line.id
+            post_data["lines-%d-order" % i] = order.id
+            post_data["lines-%d-book" % i] = line.book.id
+            post_data["lines-%d-status" % i] = models.OrderLine.SENT
+        response = self.client.post(
+            reverse("admin:main_order_change", args=(order.id,)), post_data)
+        self.assertEqual(response.status_code, 302)
+        order.refresh_from_db()
+        self.assertEqual(order.status, models.Order.DONE)
+        self.assertEqual(order.lines.filter(status=models.OrderLine.SENT).count(), 20)
         
+    def test_book_actions_refresh_autocomplete(self):
+        autocomplete.reset()
+        self.addCleanup(autocomplete.reset)
+        user = models.User.objects.create_superuser(email="admin@ebookstore.domain", password="Abcd_123")
+        self.client.force_login(user)
+        book = factories.BookFactory(name="Persuasion")
+        self.assertEqual([b["id"] for b in autocomplete.suggest("pers")], [book.id])
+        # The changelist is filtered on the flag the actions change
+        for action, active, expected in (
+                ("make_inactive", "1", []), ("make_active", "0", [book.id])):
+            response = self.client.post(
+                reverse("admin:main_book_changelist") + "?active__exact=" + active,
+                {"action": action, "_selected_action": [book.id]})
+            self.assertEqual(response.status_code, 302)
+            self.assertEqual([b["id"] for b in autocomplete.suggest("pers")], expected)
+
+    def test_basket_changelist_query_count_does_not_grow(self):
+        user = models.User.objects.create_superuser(email="admin@ebookstore.domain", password="Abcd_123")
+        self.client.force_login(user)
+        book = factories.BookFactory(price=Decimal("4.00"))
+        for i in range(30):
+            basket = models.Basket.objects.create(user=user)
+            models.BasketLine.objects.create(basket=basket, book=book, quantity=i + 1)
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse("admin:main_basket_changelist"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "120.00")
+
     # def test_invoice_renders_exactly_as_expected(self):
     #     books = [
     #         factories.BookFactory(name="Book 1", active=True, price=Decimal("100.00")),
@@ -0,0 +1,458 @@
+import csv
+import importlib
+import os.path
+import shutil
+import tempfile
+from concurrent.futures import Future
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from PIL import Image
+from django.apps import apps
+from django.core.files.images import ImageFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.template import Context, Template
+from django.test import TestCase
+from unittest.mock import patch
+from django.urls import reverse
+from django.utils import timezone
+from main import factories, models, search, thumbnails
+from main.management.commands import regenerate_thumbnails
+
+
+class TestCommands(TestCase):
+    def write_catalog(self, directory, count, changed_description=None):
+        if not os.path.exists(os.path.join(directory, 'mrbs.jpg')):
+            shutil.copy(
+                'main/fixtures/mitch-rap-book-series.jpeg',
+                os.path.join(directory, 'mrbs.jpg'))
+        path = os.path.join(directory, 'books.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name', 'description', 'tags', 'image_filename', 'price'])
+            for i in range(count):
+                writer.writerow([
+                    'Book %d' % i, changed_description if i == 0 and changed_description else 'Description %d' % i,
+                    'thriller|series %d' % (i % 2), 'mrbs.jpg', '10.00'])
+        return path
+
+    def test_import_data_bulk_mode(self):
+        with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+            path = self.write_catalog(tmp, 10)
+            out = StringIO()
+            with self.assertNumQueries(36):
+                call_command(
+                    "import_data", path, tmp, "--bulk", "--batch-size=4",
+                    "--image-workers=2", stdout=out)
+        self.assertIn("Books processed=10 (created=10, updated=0, unchanged=0)", out.getvalue())
+        self.assertIn("Tags processed=20 (created=3)", out.getvalue())
+        self.assertEqual(models.Book.objects.count(), 10)
+        self.assertEqual(models.BookTag.objects.get(name="thriller").book_set.count(), 10)
+        book = models.Book.objects.get(name="Book 3")
+        self.assertEqual(book.slug, "book-3")
+        self.assertEqual(book.description, "Description 3")
+        self.assertEqual(
+            sorted(book.tags.values_list("slug", flat=True)), ["series-1", "thriller"])
+        self.assertIn("Images processed=10 (failed=0)", out.getvalue())
+        image = book.bookimage_set.get()
+        self.assertEqual(image.thumbnail_status, models.BookImage.READY)
+        self.assertTrue(image.image_hash)
+        self.assertTrue(image.thumbnail)
+        self.assertEqual(image.derivatives.count(), 6)
+        self.assertEqual(len(search.search("thriller")), 10)
+        self.assertEqual(list(search.search("series 1 description 3")), [book])
+
+    def test_import_data_gives_books_unique_slugs(self):
+        with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+            shutil.copy('main/fixtures/mitch-rap-book-series.jpeg', os.path.join(tmp, 'mrbs.jpg'))
+            models.Book.objects.create(
+                name="Emma", slug="emma", price=Decimal("10.00"), import_key="other")
+            path = os.path.join(tmp, 'books.csv')
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['isbn', 'name', 'description', 'tags', 'image_filename', 'price'])
+                for isbn in ('1', '2'):
+                    writer.writerow([isbn, 'Emma', '', '', 'mrbs.jpg', '10.00'])
+            for mode in ([], ["--bulk", "--image-workers=1"]):
+                models.Book.objects.exclude(import_key="other").delete()
+                call_command("import_data", path, tmp, *mode, stdout=StringIO())
+                self.assertEqual(
+                    sorted(models.Book.objects.values_list("slug", flat=True)),
+                    ["emma", "emma-2", "emma-3"])
+                # Reimporting keeps the numbered slugs
+                call_command("import_data", path, tmp, "--force", *mode, stdout=StringIO())
+                self.assertEqual(
+                    sorted(models.Book.objects.values_list("slug", flat=True)),
+                    ["emma", "emma-2", "emma-3"])
+
+    def test_import_data_keys_books_without_isbn_apart(self):
+        with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+            shutil.copy('main/fixtures/mitch-rap-book-series.jpeg', os.path.join(tmp, 'mrbs.jpg'))
+            with open(os.path.join(tmp, 'mrbs.jpg'), 'rb') as f:
+                other = thumbnails.render_thumbnail(f.read(), (50, 50))
+            with open(os.path.join(tmp, 'other.jpg'), 'wb') as f:
+                f.write(other)
+            path = os.path.join(tmp, 'books.csv')
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['name', 'description', 'tags', 'image_filename', 'price'])
+                writer.writerow(['Emma', 'First', '', 'mrbs.jpg', '10.00'])
+                writer.writerow(['Emma', 'Second', '', 'other.jpg', '10.00'])
+            for mode in ([], ["--bulk", "--image-workers=1"]):
+                # Keyed by slug by an earlier import
+                old = models.Book.objects.create(
+                    name="Emma", slug="emma", price=Decimal("10.00"), import_key="emma")
+                call_command("import_data", path, tmp, *mode, stdout=StringIO())
+                books = models.Book.objects.order_by("description")
+                self.assertEqual(
+                    [book.description for book in books], ["First", "Second"])
+                self.assertEqual(books[0].id, old.id)
+                self.assertTrue(all(len(book.import_key) == 64 for book in books))
+
+                # A new image replaces the old one along with its files
+                image = old.bookimage_set.get()
+                shutil.copy(os.path.join(tmp, 'other.jpg'), os.path.join(tmp, 'mrbs.jpg'))
+                with self.captureOnCommitCallbacks(execute=True):
+                    call_command("import_data", path, tmp, *mode, stdout=StringIO())
+                self.assertEqual(models.Book.objects.count(), 2)
+                new_image = old.bookimage_set.get()
+                self.assertNotEqual(new_image.image_hash, image.image_hash)
+                self.assertFalse(default_storage.exists(image.image.name))
+                shutil.copy('main/fixtures/mitch-rap-book-series.jpeg', os.path.join(tmp, 'mrbs.jpg'))
+                models.Book.objects.all().delete()
+
+    def test_build_recommendations(self):
+        user = factories.UserFactory()
+        emma, persuasion, ivanhoe, dune = factories.BookFactory.create_batch(4)
+        for books in ([emma, persuasion], [emma, persuasion, ivanhoe],
+                      [emma, ivanhoe], [persuasion, emma], [dune]):
+            order = factories.OrderFactory(user=user)
+            for book in books:
+                factories.OrderLineFactory(order=order, book=book)
+        cancelled = factories.OrderFactory(user=user)
+        factories.OrderLineFactory(order=cancelled, book=emma)
+        factories.OrderLineFactory(
+            order=cancelled, book=dune, status=models.OrderLine.CANCELLED)
+        models.BookRecommendation.objects.create(
+            book=dune, recommended=emma, rank=1, score=1)
+
+        out = StringIO()
+        call_command("build_recommendations", "--top=1", stdout=out)
+        self.assertIn("Order lines read=11", out.getvalue())
+        self.assertEqual(
+            list(models.BookRecommendation.objects.values_list("book", "recommended", "rank")),
+            [(emma.id, persuasion.id, 1), (persuasion.id, emma.id, 1), (ivanhoe.id, emma.id, 1)])
+        recommendation = persuasion.recommendations.get()
+        self.assertAlmostEqual(recommendation.score, 3 / (5 * 3) ** 0.5, places=5)
+
+    def test_purge_baskets_deletes_stale_anonymous_baskets(self):
+        book = factories.BookFactory()
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        for i in range(4):
+            models.Basket.objects.create().add(book)
+        kept = [
+            models.Basket.objects.create(user=factories.UserFactory()),
+            models.Basket.objects.create(status=models.Basket.SUBMITTED),
+            ]
+        models.Basket.objects.update(date_updated=timezone.now() - timedelta(days=31))
+        recent = models.Basket.objects.create()
+        out = StringIO()
+        call_command("purge_baskets", "--dry-run", stdout=out)
+        self.assertIn("Stale baskets=5", out.getvalue())
+        call_command("purge_baskets", "--batch-size=2", "--pause=0", stdout=out)
+        self.assertIn("Baskets deleted=5, lines deleted=5", out.getvalue())
+        self.assertEqual(
+            set(models.Basket.objects.values_list("id", flat=True)), {b.id for b in kept + [recent]})
+        self.assertFalse(models.BasketLine.objects.exists())
+
+        # The session of a purged basket starts afresh
+        response = self.client.get(reverse("basket"))
+        self.assertContains(response, "You have no items in the basket.")
+        self.assertNotIn("basket_id", self.client.session)
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        self.assertEqual(models.Basket.objects.get(id=self.client.session["basket_id"]).count(), 1)
+
+    def test_baskets_from_before_date_updated_are_backfilled(self):
+        backfill = importlib.import_module("main.migrations.0013_basket_date_updated")
+        customer = factories.UserFactory()
+        order = factories.OrderFactory(user=customer)
+        with_orders = models.Basket.objects.create(user=customer)
+        anonymous = models.Basket.objects.create()
+        backfill.backfill_date_updated(apps, None)
+        with_orders.refresh_from_db()
+        anonymous.refresh_from_db()
+        self.assertEqual(with_orders.date_updated, models.Order.objects.get(id=order.id).date_updated)
+        self.assertEqual(anonymous.date_updated, backfill.NO_ACTIVITY)
+        out = StringIO()
+        call_command("purge_baskets", "--dry-run", stdout=out)
+        self.assertIn("Stale baskets=1", out.getvalue())
+
+    def test_backfill_order_rollups_matches_the_incremental_ones(self):
+        user1 = factories.UserFactory()
+        books = factories.BookFactory.create_batch(3, price=Decimal("7.50"))
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(6):
+                order = factories.OrderFactory(user=user1, shipping_county=("nrb", "ksm")[i % 2])
+                for book in books[:i % 3 + 1]:
+                    factories.OrderLineFactory(order=order, book=book)
+            models.OrderLine.objects.filter(book=books[0])[:1].get().delete()
+            order.date_added = timezone.now() - timedelta(days=3)
+            order.save()
+
+        def rollups():
+            return (
+                sorted(models.OrderRollup.objects.values_list("day", "county", "orders", "lines", "revenue")),
+                sorted(models.BookOrderRollup.objects.values_list("day", "county", "book_id", "lines", "revenue")))
+
+        incremental = rollups()
+        self.assertEqual(sum(row[2] for row in incremental[0]), 6)
+        self.assertEqual(sum(row[3] for row in incremental[0]), 11)
+        models.OrderRollup.objects.all().delete()
+        models.BookOrderRollup.objects.all().delete()
+        out = StringIO()
+        call_command("backfill_order_rollups", stdout=out)
+        self.assertIn("Days and counties=3", out.getvalue())
+        self.assertEqual(rollups(), incremental)
+
+        models.OrderRollup.objects.all().delete()
+        call_command("backfill_order_rollups", "--days=1", stdout=out)
+        self.assertEqual(len(rollups()[0]), 2)
+
+    def test_rebuild_search_index(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        search.get_backend().remove_books([book.id])
+        self.assertEqual(list(search.search("emma")), [])
+        out = StringIO()
+        call_command("rebuild_search_index", stdout=out)
+        self.assertIn("Books indexed=1", out.getvalue())
+        self.assertEqual(list(search.search("emma")), [book])
+
+    def test_autocomplete_stats(self):
+        for i in range(20):
+            models.Book.objects.create(name="Book %d" % i, slug="book-%d" % i, price=Decimal("10.00"))
+        out = StringIO()
+        call_command("autocomplete_stats", "--lookups=100", stdout=out)
+        self.assertIn("Books indexed=20 (keys=40)", out.getvalue())
+        self.assertIn("Lookups=100", out.getvalue())
+
+    def test_export_catalog_round_trips_through_import_data(self):
+        with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+            path = self.write_catalog(tmp, 5)
+            call_command(
+                "import_data", path, tmp, "--bulk", "--image-workers=1", stdout=StringIO())
+            export_path = os.path.join(tmp, "export.csv")
+            call_command("export_catalog", "--output=%s" % export_path, "--chunk-size=2")
+            with open(path) as original, open(export_path) as exported:
+                self.assertEqual(
+                    [(r["name"], r["description"], r["tags"], r["price"])
+                     for r in csv.DictReader(original)],
+                    [(r["name"], r["description"], r["tags"], r["price"])
+                     for r in csv.DictReader(exported)])
+
+            models.Book.objects.all().delete()
+            out = StringIO()
+            call_command("import_data", export_path, tmp, stdout=out)
+            self.assertIn("Books processed=5 (created=5, updated=0, unchanged=0)", out.getvalue())
+            self.assertIn("Images processed=5", out.getvalue())
+
+    def test_import_data_only_touches_changed_rows(self):
+        for mode in ([], ["--bulk", "--image-workers=1"]):
+            with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+                path = self.write_catalog(tmp, 10)
+                call_command("import_data", path, tmp, *mode, stdout=StringIO())
+                out = StringIO()
+                call_command("import_data", path, tmp, *mode, stdout=out)
+                self.assertIn(
+                    "Books processed=10 (created=0, updated=0, unchanged=10)", out.getvalue())
+                self.assertIn("Images processed=0", out.getvalue())
+
+                path = self.write_catalog(tmp, 10, changed_description="New description")
+                out = StringIO()
+                call_command("import_data", path, tmp, *mode, stdout=out)
+                self.assertIn(
+                    "Books processed=10 (created=0, updated=1, unchanged=9)", out.getvalue())
+                self.assertIn("Images processed=0", out.getvalue())
+            book = models.Book.objects.get(name="Book 0")
+            self.assertEqual(book.description, "New description")
+            self.assertEqual(book.tags.count(), 2)
+            self.assertEqual(models.Book.objects.count(), 10)
+            self.assertEqual(models.BookImage.objects.count(), 10)
+            models.Book.objects.all().delete()
+
+    def test_images_imported_before_hashes_are_recognised_after_migrating(self):
+        backfill = importlib.import_module("main.migrations.0015_backfill_image_hash")
+        with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+            path = self.write_catalog(tmp, 3)
+            call_command("import_data", path, tmp, stdout=StringIO())
+            models.BookImage.objects.update(image_hash="")
+            backfill.backfill_image_hash(apps, None)
+            self.assertFalse(models.BookImage.objects.filter(image_hash="").exists())
+            out = StringIO()
+            call_command("import_data", path, tmp, "--force", stdout=out)
+            self.assertIn("Images processed=0", out.getvalue())
+        self.assertEqual(models.BookImage.objects.count(), 3)
+
+    def test_import_data_reports_missing_images(self):
+        for mode in ([], ["--bulk", "--image-workers=1"]):
+            with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+                path = self.write_catalog(tmp, 3)
+                with open(path, "a", newline="") as f:
+                    csv.writer(f).writerow(["Book 3", "Description 3", "", "missing.jpg", "10.00"])
+                out = StringIO()
+                with self.assertLogs("main.management.commands.import_data", level="ERROR"):
+                    call_command("import_data", path, tmp, *mode, stdout=out)
+                self.assertIn("Books processed=4 (created=4", out.getvalue())
+                self.assertIn("Images processed=3 (failed=1)", out.getvalue())
+                self.assertIn("Image missing.jpg failed", out.getvalue())
+
+                # The row is imported again once its image is there
+                shutil.copy(os.path.join(tmp, "mrbs.jpg"), os.path.join(tmp, "missing.jpg"))
+                out = StringIO()
+                call_command("import_data", path, tmp, *mode, stdout=out)
+                self.assertIn("updated=1, unchanged=3", out.getvalue())
+                self.assertIn("Images processed=1 (failed=0)", out.getvalue())
+            models.Book.objects.all().delete()
+
+    def test_import_data_retries_rows_with_broken_images(self):
+        with tempfile.TemporaryDirectory() as tmp, self.settings(MEDIA_ROOT=tmp):
+            path = self.write_catalog(tmp, 2)
+            with open(os.path.join(tmp, "broken.jpg"), "wb") as f:
+                f.write(b"not an image")
+            with open(path, "a", newline="") as f:
+                csv.writer(f).writerow(["Book 2", "Description 2", "", "broken.jpg", "10.00"])
+            mode = ["--bulk", "--image-workers=1", "--batch-size=1"]
+            out = StringIO()
+            with self.assertLogs("main.management.commands.import_data", level="ERROR"):
+                call_command("import_data", path, tmp, *mode, stdout=out)
+            self.assertIn("Images processed=2 (failed=1)", out.getvalue())
+            self.assertFalse(models.Book.objects.get(name="Book 2").import_checksum)
+
+            # The row whose image failed is tried again, even unchanged
+            out = StringIO()
+            with self.assertLogs("main.management.commands.import_data", level="ERROR"):
+                call_command("import_data", path, tmp, *mode, stdout=out)
+            self.assertIn("updated=1, unchanged=2", out.getvalue())
+            shutil.copy(os.path.join(tmp, "mrbs.jpg"), os.path.join(tmp, "broken.jpg"))
+            out = StringIO()
+            call_command("import_data", path, tmp, *mode, stdout=out)
+            self.assertIn("updated=1, unchanged=2", out.getvalue())
+            self.assertIn("Images processed=1 (failed=0)", out.getvalue())
+            self.assertTrue(models.Book.objects.get(name="Book 2").import_checksum)
+            models.Book.objects.all().delete()
+
+    def test_benchmark_image_upload_posts_to_the_admin(self):
+        out = StringIO()
+        call_command("benchmark_image_upload", "--iterations=2", stdout=out)
+        self.assertIn("inline: median=", out.getvalue())
+        self.assertIn("queued: median=", out.getvalue())
+        # Rolled back, and the inline renderer is gone again
+        self.assertFalse(models.BookImage.objects.exists())
+        self.assertFalse(models.User.objects.exists())
+        with open('main/fixtures/mitch-rap-book-series.jpeg', 'rb') as f:
+            image = models.BookImage.objects.create(
+                book=factories.BookFactory(), image=ImageFile(f, name='mrbs.jpg'))
+        self.assertFalse(image.thumbnail)
+        image.image.delete(save=False)
+
+    def test_derivatives_are_resized_from_the_original(self):
+        with open('main/fixtures/mitch-rap-book-series.jpeg', 'rb') as f:
+            image = Image.open(f).convert('RGB')
+        # Neither size fits inside the other
+        derivatives = thumbnails.render_derivatives(
+            image, {"wide": (400, 100), "tall": (100, 400)}, ("jpeg",))
+        self.assertEqual(
+            sorted((name, width, height) for name, image_format, width, height, data in derivatives),
+            [("tall", 100, 155), ("wide", 64, 100)])
+
+    def test_backfill_derivatives_renders_missing_ones(self):
+        book = models.Book.objects.create(
+            name='Mitch Rap Book Series', price=Decimal('19.99'))
+        with open('main/fixtures/mitch-rap-book-series.jpeg', 'rb') as f:
+            image = models.BookImage.objects.create(
+                book=book, image=ImageFile(f, name='mrbs.jpg'))
+        # As if the image had been rendered before derivatives existed
+        models.BookImage.objects.update(thumbnail_status=models.BookImage.READY)
+
+        out = StringIO()
+        call_command("backfill_derivatives", "--process", "--workers=1", stdout=out)
+        self.assertIn("Images queued=1", out.getvalue())
+        self.assertEqual(image.derivatives.count(), 6)
+
+        out = StringIO()
+        call_command("backfill_derivatives", stdout=out)
+        self.assertIn("Images queued=0", out.getvalue())
+
+        html = Template(
+            '{% load book_images %}{% book_image_picture image "detail" %}'
+            ).render(Context({"image": image}))
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn(image.derivatives.get(size="detail", format="jpeg").file.url, html)
+
+        for derivative in image.derivatives.all():
+            derivative.file.delete(save=False)
+        image.refresh_from_db()
+        image.thumbnail.delete(save=False)
+        image.image.delete(save=False)
+
+    def test_regenerate_thumbnails_resumes_from_checkpoint(self):
+        book = models.Book.objects.create(
+            name='Mitch Rap Book Series', price=Decimal('19.99'))
+        images = []
+        for i in range(3):
+            with open('main/fixtures/mitch-rap-book-series.jpeg', 'rb') as f:
+                images.append(models.BookImage.objects.create(
+                    book=book, image=ImageFile(f, name='mrbs.jpg')))
+        models.BookImage.objects.update(thumbnail_status=models.BookImage.READY)
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, "checkpoint")
+            with open(checkpoint, "w") as f:
+                f.write(str(images[0].id))
+            out = StringIO()
+            call_command(
+                "regenerate_thumbnails", "--workers=1", "--chunk-size=1",
+                "--checkpoint=%s" % checkpoint, stdout=out)
+            self.assertIn("Resuming after image id=%d" % images[0].id, out.getvalue())
+            self.assertIn("Thumbnails regenerated=2", out.getvalue())
+            self.assertFalse(os.path.exists(checkpoint))
+
+        for image in images:
+            image.refresh_from_db()
+        self.assertFalse(images[0].thumbnail)
+        self.assertTrue(images[1].thumbnail)
+        self.assertTrue(images[2].thumbnail)
+        for image in images:
+            if image.thumbnail:
+                image.thumbnail.delete(save=False)
+            image.image.delete(save=False)
+
+    def test_regenerate_thumbnails_skips_images_replaced_meanwhile(self):
+        book = models.Book.objects.create(name='Mitch Rap Book Series', price=Decimal('19.99'))
+        for i in range(2):
+            with open('main/fixtures/mitch-rap-book-series.jpeg', 'rb') as f:
+                models.BookImage.objects.create(book=book, image=ImageFile(f, name='mrbs.jpg'))
+        models.BookImage.objects.update(thumbnail_status=models.BookImage.READY)
+        image, kept = models.BookImage.objects.order_by("id")
+        # Replaced after the command read it
+        models.BookImage.objects.filter(id=image.id).update(
+            image_hash="new", thumbnail_status=models.BookImage.PENDING)
+        future = Future()
+        future.set_result(b"thumbnail")
+        storage = models.BookImage._meta.get_field("thumbnail").storage
+        # Checked and written in bulk, whatever the size of the chunk
+        with patch.object(storage, "delete", wraps=storage.delete) as delete, \
+                self.assertNumQueries(5):
+            stored = regenerate_thumbnails.Command().store_chunk([(image, future), (kept, future)])
+        self.assertEqual(stored, 1)
+        self.assertEqual(delete.call_count, 1)
+        self.assertFalse(storage.exists(delete.call_args[0][0]))
+        image.refresh_from_db()
+        self.assertEqual(image.thumbnail_status, models.BookImage.PENDING)
+        self.assertFalse(image.thumbnail)
+        kept.refresh_from_db()
+        self.assertEqual(kept.thumbnail_status, models.BookImage.READY)
+        self.assertTrue(storage.exists(kept.thumbnail.name))
+        for image in (image, kept):
+            if image.thumbnail:
+                image.thumbnail.delete(save=False)
+            image.image.delete(save=False)
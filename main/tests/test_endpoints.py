@@ -0,0 +1,71 @@
+from django.contrib.auth.models import Permission
+from django.test import TestCase
+from django.urls import reverse
+from main import factories
+from main import models
+from main import endpoints
+
+
+class TestEndpoints(TestCase):
+    def setUp(self):
+        self.user = factories.UserFactory(email="dispatcher@ebookstore.domain")
+        self.user.user_permissions.add(
+            Permission.objects.get(codename="change_orderline"))
+        self.book = factories.BookFactory()
+        self.paid_order = factories.OrderFactory(user=self.user, status=models.Order.PAID)
+        self.new_order = factories.OrderFactory(user=self.user)
+
+    def test_bulk_status_updates_paid_lines_only(self):
+        paid_lines = factories.OrderLineFactory.create_batch(
+            30, order=self.paid_order, book=self.book)
+        new_line = factories.OrderLineFactory(order=self.new_order, book=self.book)
+        ids = [line.id for line in paid_lines] + [new_line.id, 9999]
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse("orderline-bulk-status"),
+            {"ids": ids, "status": models.OrderLine.SENT},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["updated"], sorted(line.id for line in paid_lines))
+        self.assertEqual(response.json()["not_found"], sorted([new_line.id, 9999]))
+        self.assertEqual(
+            models.OrderLine.objects.filter(status=models.OrderLine.SENT).count(), 30)
+        self.paid_order.refresh_from_db()
+        self.assertEqual(self.paid_order.status, models.Order.DONE)
+
+    def test_bulk_status_requires_change_permission(self):
+        user2 = factories.UserFactory(email="customer@ebookstore.domain")
+        line = factories.OrderLineFactory(order=self.paid_order, book=self.book)
+        self.client.force_login(user2)
+        response = self.client.post(
+            reverse("orderline-bulk-status"),
+            {"ids": [line.id], "status": models.OrderLine.SENT},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+        line.refresh_from_db()
+        self.assertEqual(line.status, models.OrderLine.NEW)
+
+    def test_line_update_only_writes_the_status(self):
+        line = factories.OrderLineFactory(order=self.paid_order, book=self.book)
+        self.client.force_login(self.user)
+        response = self.client.patch(
+            reverse("orderline-detail", args=[line.id]),
+            {"status": models.OrderLine.SENT, "book": "Another book"},
+            content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], models.OrderLine.SENT)
+        self.assertEqual(response.json()["book"], str(self.book))
+        line.refresh_from_db()
+        self.assertEqual((line.status, line.book), (models.OrderLine.SENT, self.book))
+        self.assertIn("book", endpoints.OrderLineSerializer.Meta.read_only_fields)
+
+    def test_search_is_public_and_paginated(self):
+        for i in range(25):
+            models.Book.objects.create(
+                name="Dune %d" % i, slug="dune-%d" % i, price="9.99")
+        response = self.client.get(reverse("search-list"), {"q": "dune"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 25)
+        self.assertEqual(len(response.json()["results"]), 20)
+        response = self.client.get(reverse("search-list"), {"q": "dune", "page": 2})
+        self.assertEqual(len(response.json()["results"]), 5)
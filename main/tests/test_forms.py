@@ -15,6 +15,16 @@ class TestForm(TestCase):
         self.assertEqual(mail.outbox[0].subject, 'Site message')
         self.assertGreaterEqual(len(cf.output), 1)
         
+    def test_period_select_form_takes_a_preset_or_custom_window(self):
+        form = forms.PeriodSelectForm({"period": "60"})
+        self.assertTrue(form.is_valid())
+        self.assertEqual((form.cleaned_data["window"], form.cleaned_data["limit"]), (60, 20))
+        form = forms.PeriodSelectForm({"period": "30", "days": "7", "limit": "5"})
+        self.assertTrue(form.is_valid())
+        self.assertEqual((form.cleaned_data["window"], form.cleaned_data["limit"]), (7, 5))
+        self.assertFalse(forms.PeriodSelectForm({}).is_valid())
+        self.assertFalse(forms.PeriodSelectForm({"days": "0"}).is_valid())
+
     def test_invalid_contact_us_form(self):
         form = forms.ContactUsForm({'message': "Hi there"})
         self.assertFalse(form.is_valid())
@@ -1,7 +1,10 @@
 from django.test import TestCase
+from django.db import IntegrityError, transaction
 from main import models
 from decimal import Decimal
+from django.utils import timezone
 from main import factories
+from main import exceptions
 
 
 class TestModels(TestCase):
@@ -30,6 +33,169 @@ class TestModels(TestCase):
             self.assertEquals(lines[0].book, bk1)
             self.assertEquals(lines[1].book, bk2)
 
+    def test_create_order_uses_constant_queries(self):
+        user1 = factories.UserFactory()
+        billing = factories.AddressFactory(user=user1)
+        basket = models.Basket.objects.create(user=user1)
+        for book in factories.BookFactory.create_batch(5):
+            models.BasketLine.objects.create(basket=basket, book=book, quantity=20)
+        # The rollups are updated after the commit, outside the checkout
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertNumQueries(6):
+                order = basket.create_order(billing, billing)
+        self.assertEquals(len(callbacks), 1)
+        self.assertEquals(order.lines.count(), 100)
+        self.assertEquals(basket.status, models.Basket.SUBMITTED)
+        rollup = models.OrderRollup.objects.get()
+        self.assertEquals((rollup.orders, rollup.lines), (1, 100))
+
+    def test_create_order_refuses_submitted_basket(self):
+        user1 = factories.UserFactory()
+        billing = factories.AddressFactory(user=user1)
+        basket = models.Basket.objects.create(user=user1)
+        models.BasketLine.objects.create(basket=basket, book=factories.BookFactory())
+        basket.create_order(billing, billing)
+        stale_basket = models.Basket.objects.get(id=basket.id)
+        stale_basket.status = models.Basket.OPEN
+        with self.assertRaises(exceptions.BasketException):
+            stale_basket.create_order(billing, billing)
+        self.assertEquals(models.Order.objects.count(), 1)
+
+    def test_basket_totals_are_computed_in_sql(self):
+        user1 = factories.UserFactory()
+        basket = models.Basket.objects.create(user=user1)
+        empty = models.Basket.objects.create()
+        models.BasketLine.objects.create(
+            basket=basket, book=factories.BookFactory(price=Decimal("10.00")), quantity=3)
+        models.BasketLine.objects.create(
+            basket=basket, book=factories.BookFactory(price=Decimal("2.50")), quantity=2)
+        with self.assertNumQueries(1):
+            baskets = list(models.Basket.objects.with_totals().order_by("id"))
+            self.assertEqual(
+                [b.totals() for b in baskets],
+                [{"line_count": 2, "item_count": 5, "total_price": Decimal("35.00")},
+                 {"line_count": 0, "item_count": 0, "total_price": Decimal("0")}])
+        with self.assertNumQueries(1):
+            self.assertEqual(basket.count(), 5)
+        with self.assertNumQueries(1):
+            self.assertTrue(empty.is_empty())
+
+    def test_basket_add_bumps_a_single_line(self):
+        basket = models.Basket.objects.create()
+        book = factories.BookFactory()
+        basket.add(book)
+        basket.add(book, 2)
+        self.assertEqual(
+            list(basket.basketline_set.values_list("book_id", "quantity")), [(book.id, 3)])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            models.BasketLine.objects.create(basket=basket, book=book)
+        basket.set_quantity(book, 5)
+        self.assertEqual(basket.count(), 5)
+        basket.set_quantity(book, 0)
+        self.assertTrue(basket.is_empty())
+        basket.set_quantity(book, 1)
+        basket.remove(book)
+        self.assertTrue(basket.is_empty())
+
+    def test_basket_merge_sums_shared_books_in_constant_queries(self):
+        def baskets(size):
+            shared = factories.BookFactory()
+            basket = models.Basket.objects.create()
+            other = models.Basket.objects.create()
+            basket.add(shared, 2)
+            other.add(shared, 3)
+            for book in factories.BookFactory.create_batch(size):
+                other.add(book)
+            return basket, other, shared
+
+        basket, other, shared = baskets(1)
+        with self.assertNumQueries(9) as small:
+            basket.merge(other)
+        self.assertEqual(
+            dict(basket.basketline_set.values_list("book_id", "quantity"))[shared.id], 5)
+        self.assertEqual(basket.count(), 6)
+        self.assertFalse(models.Basket.objects.filter(id=other.id).exists())
+
+        basket, other, shared = baskets(20)
+        with self.assertNumQueries(len(small.captured_queries)):
+            basket.merge(other)
+        self.assertEqual(basket.count(), 25)
+        self.assertEqual(models.BasketLine.objects.filter(basket=basket, book=shared).count(), 1)
+
+    def test_orderline_set_status_propagates_to_orders(self):
+        user1 = factories.UserFactory()
+        book = factories.BookFactory()
+        order1, order2 = factories.OrderFactory.create_batch(2, user=user1)
+        factories.OrderLineFactory.create_batch(50, order=order1, book=book)
+        factories.OrderLineFactory.create_batch(2, order=order2, book=book)
+        lines = models.OrderLine.objects.filter(order=order1)
+        with self.assertNumQueries(6):
+            updated = lines.set_status(models.OrderLine.SENT)
+        self.assertEquals(updated, 50)
+        order1.refresh_from_db()
+        order2.refresh_from_db()
+        self.assertEquals(order1.status, models.Order.DONE)
+        self.assertEquals(order2.status, models.Order.NEW)
+
+
+    def test_order_rollups_follow_orders(self):
+        user1 = factories.UserFactory()
+        book1 = factories.BookFactory(price=Decimal("10.00"))
+        book2 = factories.BookFactory(price=Decimal("5.00"))
+        with self.captureOnCommitCallbacks(execute=True):
+            order1 = factories.OrderFactory(user=user1, shipping_county="nrb")
+            order2 = factories.OrderFactory(user=user1, shipping_county="nrb")
+            factories.OrderLineFactory.create_batch(2, order=order1, book=book1)
+            line = factories.OrderLineFactory(order=order1, book=book2)
+            factories.OrderLineFactory(order=order2, book=book2)
+        today = timezone.localdate()
+
+        def rollups():
+            return (
+                list(models.OrderRollup.objects.values_list("day", "county", "orders", "lines", "revenue")),
+                sorted(models.BookOrderRollup.objects.values_list("county", "book_id", "lines", "revenue")))
+
+        self.assertEqual(rollups(), (
+            [(today, "nrb", 2, 4, Decimal("30.00"))],
+            [("nrb", book1.id, 2, Decimal("20.00")), ("nrb", book2.id, 2, Decimal("10.00"))]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order1.lines.filter(book=book1).set_status(models.OrderLine.CANCELLED)
+        self.assertEqual(rollups(), (
+            [(today, "nrb", 2, 2, Decimal("10.00"))], [("nrb", book2.id, 2, Decimal("10.00"))]))
+
+        # Saves that leave the day, county, book and cancellation alone do
+        # not touch the rollups
+        order1 = models.Order.objects.get(id=order1.id)
+        order1.status = models.Order.PAID
+        line = models.OrderLine.objects.get(id=line.id)
+        line.status = models.OrderLine.SENT
+        with self.captureOnCommitCallbacks() as callbacks, self.assertNumQueries(3):
+            order1.save()
+            line.save()
+        self.assertEqual(callbacks, [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            line.book = book1
+            line.save()
+        self.assertEqual(rollups(), (
+            [(today, "nrb", 2, 2, Decimal("15.00"))],
+            [("nrb", book1.id, 1, Decimal("10.00")), ("nrb", book2.id, 1, Decimal("5.00"))]))
+        with self.captureOnCommitCallbacks(execute=True):
+            line.delete()
+        self.assertEqual(rollups()[0], [(today, "nrb", 2, 1, Decimal("5.00"))])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order2.shipping_county = "ksm"
+            order2.save()
+        self.assertEqual(sorted(rollups()[0]), [
+            (today, "ksm", 1, 1, Decimal("5.00")), (today, "nrb", 1, 0, Decimal("0.00"))])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            order2.delete()
+            order1.lines.set_status(models.OrderLine.NEW)
+        self.assertEqual(rollups(), (
+            [(today, "nrb", 1, 2, Decimal("20.00"))], [("nrb", book1.id, 2, Decimal("20.00"))]))
 
 
 # class TestModels(TestCase):
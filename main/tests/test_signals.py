@@ -1,11 +1,15 @@
-from django.test import TestCase
+from io import StringIO
+from django.core.management import call_command
+from django.contrib.auth.signals import user_logged_in
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, TestCase
 from django.core.files.images import ImageFile
 from decimal import Decimal
-from main import models
+from main import models, factories, search
 
 
 class TestSignal(TestCase):
-    def test_thumbnails_are_generated_on_save(self):
+    def test_thumbnails_are_queued_on_save(self):
         book = models.Book(
             name='Mitch Rap Book Series',
             price=Decimal('19.99')
@@ -22,11 +26,87 @@ class TestSignal(TestCase):
 
         self.assertGreaterEqual(len(cm.output), 1)
         image.refresh_from_db()
+        self.assertEqual(image.thumbnail_status, models.BookImage.PENDING)
+        self.assertFalse(image.thumbnail)
 
-        # with open(
-        #         'main/fixtures/mitch-rap-book-series.jpeg', 'rb') as f:
-        #     expected_content = f.read()
-        #     assert image.thumbnail.read() == expected_content
+        call_command("process_thumbnails", "--once", "--workers=1", stdout=StringIO())
+        image.refresh_from_db()
+        self.assertEqual(image.thumbnail_status, models.BookImage.READY)
+        self.assertTrue(image.thumbnail)
+        self.assertEqual(image.derivatives.count(), 6)
+        detail = image.derivatives.get(size="detail", format="webp")
+        self.assertEqual(detail.height, 600)
+
+        # Saving again without replacing the image does not queue it again
+        image.save()
+        image.refresh_from_db()
+        self.assertEqual(image.thumbnail_status, models.BookImage.READY)
 
+        for derivative in image.derivatives.all():
+            derivative.file.delete(save=False)
         image.thumbnail.delete(save=False)
         image.image.delete(save=False)
+
+    def test_login_merges_the_anonymous_basket(self):
+        user = factories.UserFactory(email="user1@ebookstore.domain")
+        book = factories.BookFactory()
+        basket = models.Basket.objects.create(user=user)
+        basket.add(book, 2)
+        anonymous_basket = models.Basket.objects.create()
+        anonymous_basket.add(book)
+        anonymous_basket.add(factories.BookFactory())
+        request = RequestFactory().get("/")
+        request.session = SessionStore()
+        request.session["basket_id"] = anonymous_basket.id
+        request.basket = anonymous_basket
+        user_logged_in.send(sender=user.__class__, request=request, user=user)
+        self.assertEqual(request.basket, basket)
+        self.assertEqual(request.session["basket_id"], basket.id)
+        self.assertEqual(basket.count(), 4)
+        self.assertEqual(basket.basketline_set.count(), 2)
+        self.assertFalse(models.Basket.objects.filter(id=anonymous_basket.id).exists())
+
+        # Without an open basket of their own, the user takes the anonymous one
+        other_user = factories.UserFactory(email="user2@ebookstore.domain")
+        anonymous_basket = models.Basket.objects.create()
+        request.basket = anonymous_basket
+        user_logged_in.send(sender=other_user.__class__, request=request, user=other_user)
+        anonymous_basket.refresh_from_db()
+        self.assertEqual(anonymous_basket.user, other_user)
+
+    def test_orderline_save_marks_order_done(self):
+        user1 = factories.UserFactory()
+        order = factories.OrderFactory(user=user1)
+        lines = factories.OrderLineFactory.create_batch(
+            2, order=order, book=factories.BookFactory())
+        lines[0].status = models.OrderLine.SENT
+        lines[0].save()
+        order.refresh_from_db()
+        self.assertEqual(order.status, models.Order.NEW)
+        lines[1].status = models.OrderLine.CANCELLED
+        lines[1].save()
+        order.refresh_from_db()
+        self.assertEqual(order.status, models.Order.DONE)
+
+    def test_search_index_follows_books_and_tags(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        tag = models.BookTag.objects.create(name="Regency", slug="regency")
+        self.assertEqual(list(search.search("regency")), [])
+        book.tags.add(tag)
+        self.assertEqual(list(search.search("regency")), [book])
+        tag.name = "Romance"
+        tag.save()
+        self.assertEqual(list(search.search("regency")), [])
+        self.assertEqual(list(search.search("romance")), [book])
+        tag.book_set.clear()
+        self.assertEqual(list(search.search("romance")), [])
+        book.tags.add(tag)
+        modified = models.Book.objects.get(id=book.id).date_updated
+        tag.delete()
+        self.assertEqual(list(search.search("romance")), [])
+        self.assertGreater(models.Book.objects.get(id=book.id).date_updated, modified)
+        book.name = "Persuasion"
+        book.save()
+        self.assertEqual(list(search.search("persuasion")), [book])
+        book.delete()
+        self.assertEqual(list(search.search("persuasion")), [])
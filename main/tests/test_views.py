@@ -1,9 +1,13 @@
-from main import forms, models
-from django.test import TestCase
+from main import autocomplete, facets, factories, forms, models
+from django.test import Client, TestCase
 from django.urls import reverse
 from decimal import Decimal
 from unittest.mock import patch
 from django.contrib import auth
+from io import StringIO
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import timezone
 
 
 class TestPage(TestCase):
@@ -11,6 +15,9 @@ class TestPage(TestCase):
     response containing name ebookstore.
     '''
 
+    def setUp(self):
+        cache.clear()
+
     def test_home_page_works(self):
         # response = self.client.get(reverse("home"))
         response = self.client.get('/')
@@ -50,6 +57,23 @@ class TestPage(TestCase):
         book_list = models.Book.objects.active().order_by("name")
         self.assertEqual(list(response.context["object_list"]), list(book_list))
 
+    def test_books_page_shows_covers_with_srcset(self):
+        for name in ("Emma", "Persuasion"):
+            book = models.Book.objects.create(name=name, slug=name.lower(), price=Decimal("10.00"))
+            image = models.BookImage.objects.create(
+                book=book, image="book-images/%s.jpg" % book.slug)
+            for size, width in (("list", 200), ("detail", 400)):
+                models.BookImageDerivative.objects.create(
+                    book_image=image, size=size, format="jpeg", width=width, height=width,
+                    file="book-derivatives/%s-%s.jpg" % (book.slug, size))
+        models.Book.objects.create(name="Ivanhoe", slug="ivanhoe", price=Decimal("10.00"))
+        response = self.client.get(reverse("books", kwargs={"tag": "all"}))
+        self.assertContains(
+            response,
+            'srcset="/media/book-derivatives/emma-list.jpg 200w, '
+            '/media/book-derivatives/emma-detail.jpg 400w" sizes="200px" alt="Emma"')
+        self.assertContains(response, "<picture>", count=2)
+
     def test_products_page_filters_by_tags_and_active(self):
         cp = models.Book.objects.create(
             name="The Laws of Human Nature",
@@ -62,6 +86,345 @@ class TestPage(TestCase):
         book_list = models.Book.objects.active().filter(tags__slug="personal-development")
         self.assertEqual(list(response.context["object_list"]), list(book_list))
 
+    def test_books_page_keyset_cursors_walk_all_books(self):
+        for i in range(12):
+            models.Book.objects.create(
+                name="Book %02d" % (i // 2), slug="book-%d" % i, price=Decimal("10.00"))
+        expected = list(models.Book.objects.active().order_by("name", "id"))
+        seen = []
+        params = {}
+        while True:
+            response = self.client.get(reverse("books", kwargs={"tag": "all"}), params)
+            self.assertEqual(response.status_code, 200)
+            page = response.context["page_obj"]
+            seen.extend(page.object_list)
+            if not page.has_next():
+                break
+            params = {"cursor": page.next_cursor}
+        self.assertEqual(seen, expected)
+        self.assertEqual(response.context["page_count_estimate"], 3)
+        response = self.client.get(
+            reverse("books", kwargs={"tag": "all"}), {"cursor": page.previous_cursor})
+        self.assertEqual(list(response.context["object_list"]), expected[5:10])
+        self.assertTrue(response.context["page_obj"].has_previous())
+
+    def test_books_page_facets(self):
+        fiction = models.BookTag.objects.create(name="Fiction", slug="fiction")
+        poetry = models.BookTag.objects.create(name="Poetry", slug="poetry")
+        cheap_fiction = models.Book.objects.create(
+            name="A", slug="a", price=Decimal("5.00"))
+        cheap_fiction.tags.add(fiction)
+        fiction_poetry = models.Book.objects.create(
+            name="B", slug="b", price=Decimal("15.00"), in_stock=False)
+        fiction_poetry.tags.add(fiction, poetry)
+        poetry_only = models.Book.objects.create(
+            name="C", slug="c", price=Decimal("15.00"))
+        poetry_only.tags.add(poetry)
+        models.Book.objects.create(name="D", slug="d", price=Decimal("60.00"))
+
+        response = self.client.get(
+            reverse("books", kwargs={"tag": "all"}), {"tag": ["poetry", "nope"], "price": "10-20"})
+        self.assertEqual(list(response.context["object_list"]), [fiction_poetry, poetry_only])
+        counts = response.context["facets"]
+        self.assertEqual(counts["total"], 2)
+        self.assertEqual(counts["in_stock"], 1)
+        self.assertEqual(
+            counts["tags"], [("fiction", "Fiction", 1, False), ("poetry", "Poetry", 2, True)])
+        self.assertEqual(
+            [(slug, count, selected) for slug, label, count, selected in counts["prices"]],
+            [("under-10", 0, False), ("10-20", 2, True), ("20-50", 0, False), ("50-plus", 0, False)])
+        self.assertEqual(response.context["selection"].query_string(), "tag=poetry&price=10-20")
+        self.assertContains(response, 'value="poetry" checked')
+
+        selection = facets.Selection(response.wsgi_request.GET)
+        cache.clear()
+        facets.active_tags()
+        # The totals and prices, then the tags, whatever the number of tags
+        with self.assertNumQueries(2):
+            selection.counts(models.Book.objects.active(), "all")
+        with self.assertNumQueries(0):
+            selection.counts(models.Book.objects.active(), "all")
+        with self.captureOnCommitCallbacks(execute=True):
+            poetry_only.in_stock = False
+            poetry_only.save()
+        self.assertEqual(selection.counts(models.Book.objects.active(), "all")["in_stock"], 0)
+
+    def test_book_page_query_count_does_not_grow_with_images(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        for i in range(3):
+            book.tags.create(name="Tag %d" % i, slug="tag-%d" % i)
+            image = models.BookImage.objects.create(
+                book=book, image="book-images/emma-%d.jpg" % i,
+                thumbnail="book-thumbnails/emma-%d.jpg" % i)
+            for size, width in (("list", 200), ("detail", 400)):
+                models.BookImageDerivative.objects.create(
+                    book_image=image, size=size, format="jpeg", width=width, height=width,
+                    file="book-derivatives/emma-%d-%s.jpg" % (i, size))
+        # The conditional GET validators, then the page itself
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse("book", kwargs={"slug": "emma"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Tag 0,Tag 1,Tag 2")
+        self.assertContains(response, "/media/book-derivatives/emma-2-detail.jpg")
+        self.assertNotContains(response, "Customers also bought")
+
+    def test_book_page_shows_active_recommendations(self):
+        emma, persuasion, ivanhoe = (
+            models.Book.objects.create(name=name, slug=name.lower(), price=Decimal("10.00"))
+            for name in ("Emma", "Persuasion", "Ivanhoe"))
+        ivanhoe.active = False
+        ivanhoe.save()
+        models.BookRecommendation.objects.create(book=emma, recommended=persuasion, rank=1, score=1)
+        models.BookRecommendation.objects.create(book=emma, recommended=ivanhoe, rank=2, score=1)
+        response = self.client.get(reverse("book", kwargs={"slug": "emma"}))
+        self.assertContains(response, "Customers also bought")
+        self.assertContains(response, reverse("book", kwargs={"slug": "persuasion"}))
+        self.assertNotContains(response, "Ivanhoe")
+
+        # Changes to the recommendations invalidate the page validators
+        url = reverse("book", kwargs={"slug": "emma"})
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        models.Book.objects.filter(id=persuasion.id).update(date_updated=timezone.now())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("build_recommendations", stdout=StringIO())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_catalog_pages_answer_conditional_gets(self):
+        tag = models.BookTag.objects.create(name="Classics", slug="classics")
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        book.tags.add(tag)
+        for url in (reverse("book", kwargs={"slug": "emma"}),
+                    reverse("books", kwargs={"tag": "classics"})):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("public", response["Cache-Control"])
+            self.assertIn("s-maxage=60", response["Cache-Control"])
+            etag = response["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(
+                url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+            self.assertEqual(response.status_code, 304)
+
+            models.Book.objects.touch([book.id])
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response["ETag"], etag)
+
+        # Deactivating a book changes the listing it disappears from
+        etag = self.client.get(reverse("books", kwargs={"tag": "all"}))["ETag"]
+        other = models.Book.objects.create(name="Ivanhoe", slug="ivanhoe", price=Decimal("10.00"))
+        response = self.client.get(reverse("books", kwargs={"tag": "all"}), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        other.delete()
+        response = self.client.get(reverse("books", kwargs={"tag": "all"}), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_catalog_pages_with_a_basket_are_private(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        url = reverse("book", kwargs={"slug": "emma"})
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        response = self.client.get(url)
+        self.assertIn("private", response["Cache-Control"])
+        self.assertFalse(response.has_header("Last-Modified"))
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_catalog_fragments_are_cached_until_the_catalog_changes(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        url = reverse("book", kwargs={"slug": "emma"})
+        self.assertContains(self.client.get(url), "Emma")
+        # Only the validators are queried on a hit
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get(url), "Emma")
+        with self.captureOnCommitCallbacks(execute=True):
+            book.name = "Persuasion"
+            book.save()
+        self.assertContains(self.client.get(url), "Persuasion")
+
+        self.client.get(reverse("books", kwargs={"tag": "all"}))
+        with self.captureOnCommitCallbacks(execute=True):
+            book.tags.create(name="Classics", slug="classics")
+        self.assertContains(self.client.get(reverse("books", kwargs={"tag": "all"})), "Classics")
+        self.assertContains(self.client.get("/"), "homepage")
+        self.assertContains(self.client.get("/"), "homepage")
+
+        staff = models.User.objects.create_user("staff@ebookstore.domain", "pw", is_staff=True)
+        self.client.force_login(staff)
+        stats = self.client.get(reverse("catalog_cache_stats")).json()
+        self.assertEqual(stats["fragments/book_detail.html"], {"hits": 1, "misses": 2})
+        self.assertEqual(stats["fragments/book_list.html"], {"hits": 0, "misses": 2})
+        self.assertEqual(stats["fragments/home.html"], {"hits": 1, "misses": 1})
+        stats = self.client.post(reverse("catalog_cache_stats")).json()
+        self.assertEqual(stats["fragments/home.html"], {"hits": 0, "misses": 0})
+
+    def test_home_page_lists_active_bestsellers(self):
+        user1 = factories.UserFactory()
+        order = factories.OrderFactory(user=user1)
+        emma = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        persuasion = models.Book.objects.create(
+            name="Persuasion", slug="persuasion", price=Decimal("10.00"))
+        hidden = models.Book.objects.create(
+            name="Hidden", slug="hidden", price=Decimal("10.00"), active=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            factories.OrderLineFactory.create_batch(3, order=order, book=hidden)
+            factories.OrderLineFactory.create_batch(2, order=order, book=persuasion)
+            factories.OrderLineFactory(order=order, book=emma)
+        response = self.client.get("/")
+        self.assertEqual(
+            [book["name"] for book in response.context["bestsellers"]], ["Persuasion", "Emma"])
+        self.assertContains(response, "Bestsellers of the last 30 days")
+        self.assertNotContains(response, "Hidden")
+        with self.assertNumQueries(0):
+            self.client.get("/")
+
+        # A new order shows on the next visit
+        with self.captureOnCommitCallbacks(execute=True):
+            factories.OrderLineFactory.create_batch(3, order=order, book=emma)
+        response = self.client.get("/")
+        self.assertLess(
+            response.content.index(b"Emma"), response.content.index(b"Persuasion"))
+
+    def test_cached_fragments_leave_the_basket_out(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        url = reverse("book", kwargs={"slug": "emma"})
+        self.assertRegex(
+            self.client.get(url).content.decode(), r'<div id="basket-summary">\s*</div>')
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        self.assertContains(self.client.get(url), "1 items in basket")
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        self.assertContains(self.client.get(url), "2 items in basket")
+
+    def test_catalog_cache_stats_are_staff_only(self):
+        response = self.client.get(reverse("catalog_cache_stats"))
+        self.assertEqual(response.status_code, 302)
+
+    def test_basket_is_only_loaded_when_used(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        # The session only
+        with self.assertNumQueries(1):
+            self.client.get(reverse("autocomplete"), {"q": "em"})
+        # The header badge is computed once, then read from the session
+        self.assertContains(self.client.get("/"), "1 items in basket")
+        with self.assertNumQueries(1):
+            self.assertContains(self.client.get("/"), "1 items in basket")
+
+    def test_deleted_basket_is_forgotten(self):
+        book = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        models.Basket.objects.all().delete()
+        response = self.client.get(reverse("basket"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "You have no items in the basket.")
+        self.assertNotIn("basket_id", self.client.session)
+        self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        self.assertEqual(models.Basket.objects.get().count(), 1)
+
+    def test_basket_page_query_count_does_not_grow_with_lines(self):
+        for i in range(10):
+            book = models.Book.objects.create(
+                name="Book %d" % i, slug="book-%d" % i, price=Decimal("10.00"))
+            self.client.get(reverse("add_to_basket"), {"book_id": book.id})
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse("basket"))
+        self.assertContains(response, "10 items, total 100.00")
+
+    def test_search_ranks_name_matches_first_and_hides_inactive(self):
+        tag = models.BookTag.objects.create(name="Dragons", slug="dragons")
+        in_description = models.Book.objects.create(
+            name="The Hobbit", slug="the-hobbit", price=Decimal("10.00"),
+            description="A dragon guards the treasure")
+        in_name = models.Book.objects.create(
+            name="Dragon Rider", slug="dragon-rider", price=Decimal("10.00"))
+        in_tags = models.Book.objects.create(
+            name="Eragon", slug="eragon", price=Decimal("10.00"))
+        in_tags.tags.add(tag)
+        models.Book.objects.create(
+            name="Dragon Tales", slug="dragon-tales", price=Decimal("10.00"), active=False)
+        models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+
+        response = self.client.get(reverse("search"), {"q": "drag"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "search.html")
+        self.assertEqual(
+            list(response.context["object_list"]), [in_name, in_tags, in_description])
+        self.assertContains(response, "3 results")
+
+        response = self.client.get(reverse("search"), {"q": '"unbalanced AND ('})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context["object_list"]), [])
+
+    def test_autocomplete_serves_suggestions_from_memory(self):
+        autocomplete.reset()
+        self.addCleanup(autocomplete.reset)
+        rings = models.Book.objects.create(
+            name="The Lord of the Rings", slug="lotr", price=Decimal("10.00"))
+        models.Book.objects.create(name="Ringworld", slug="ringworld", price=Decimal("10.00"))
+        models.Book.objects.create(
+            name="Rings Hidden", slug="rings-hidden", price=Decimal("10.00"), active=False)
+        self.client.get(reverse("autocomplete"), {"q": "x"})
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("autocomplete"), {"q": " RÍNG"})
+        self.assertEqual(
+            [book["name"] for book in response.json()["results"]],
+            ["The Lord of the Rings", "Ringworld"])
+        self.assertEqual(
+            response.json()["results"][0], {"id": rings.id, "name": rings.name, "slug": "lotr"})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rings.name = "The Two Towers"
+            rings.save()
+        response = self.client.get(reverse("autocomplete"), {"q": "t"})
+        self.assertEqual(
+            [book["name"] for book in response.json()["results"]], ["The Two Towers"])
+        response = self.client.get(reverse("autocomplete"), {"q": "rings"})
+        self.assertEqual(response.json()["results"], [])
+
+    def test_expired_autocomplete_index_is_rebuilt_in_the_background(self):
+        autocomplete.reset()
+        self.addCleanup(autocomplete.reset)
+        emma = models.Book.objects.create(name="Emma", slug="emma", price=Decimal("10.00"))
+        self.assertEqual(len(autocomplete.suggest("em")), 1)
+        models.Book.objects.create(name="Emmanuelle", slug="emmanuelle", price=Decimal("10.00"))
+        with self.settings(AUTOCOMPLETE_MAX_AGE=0), \
+                patch("main.autocomplete.threading.Thread") as thread:
+            # The old index answers until the new one is built
+            self.assertEqual(len(autocomplete.suggest("em")), 1)
+            self.assertEqual(len(autocomplete.suggest("em")), 1)
+            self.assertEqual(thread.call_count, 1)
+            def read_then_deactivate():
+                books = list(models.Book.objects.values_list("id", "name", "slug"))
+                models.Book.objects.filter(id=emma.id).update(active=False)
+                autocomplete.remove_books([emma.id])
+                return books
+
+            with patch("main.autocomplete.active_books", read_then_deactivate):
+                autocomplete.rebuild()
+        # Emma, deactivated after the catalog was read, stays out
+        self.assertEqual(
+            [book["name"] for book in autocomplete.suggest("em")], ["Emmanuelle"])
+
+    def test_autocomplete_index_survives_missing_entries(self):
+        index = autocomplete.PrefixIndex([(1, "Emma", "emma"), (2, "Persuasion", "persuasion")])
+        self.assertEqual((len(index.ids), index.key(0)), (2, "emma"))
+        # Diverged from the books it remembers
+        del index.ids[0]
+        del index.starts[0]
+        index.update(removed=[1])
+        index.update([(2, "Persuasion, a novel", "persuasion")])
+        self.assertEqual([index.key(i) for i in range(len(index.ids))], [
+            "a novel", "novel", "persuasion, a novel"])
+        self.assertEqual(index.lookup("nov"), [
+            {"id": 2, "name": "Persuasion, a novel", "slug": "persuasion"}])
+
     def test_user_signup_page_loads_correctly(self):
         response = self.client.get(reverse("signup"))
         self.assertEqual(response.status_code, 200)
@@ -137,6 +500,47 @@ class TestPage(TestCase):
         self.assertEquals(models.BasketLine.objects.filter(basket__user=user1).count(),2)
         self.assertEqual(response.status_code, 302)
         
+    def test_basket_api_adds_updates_and_removes_lines(self):
+        book = models.Book.objects.create(
+            name="The way of men", slug="the-way-of-men", price=Decimal("10.00"))
+        response = self.client.post(reverse("basket_api_add"), {"book_id": book.id})
+        self.assertEqual(
+            response.json(), {"book_id": book.id, "quantity": 1, "lines": 1, "count": 1})
+        response = self.client.post(reverse("basket_api_add"), {"book_id": book.id, "quantity": 2})
+        self.assertEqual(response.json()["quantity"], 3)
+        self.assertEqual(models.BasketLine.objects.get().quantity, 3)
+        response = self.client.post(reverse("basket_api_update"), {"book_id": book.id, "quantity": 5})
+        self.assertEqual(response.json()["count"], 5)
+        self.assertContains(self.client.get("/"), "5 items in basket")
+        response = self.client.post(reverse("basket_api_remove"), {"book_id": book.id})
+        self.assertEqual(
+            response.json(), {"book_id": book.id, "quantity": 0, "lines": 0, "count": 0})
+        self.assertFalse(models.BasketLine.objects.exists())
+
+    def test_basket_api_rejects_bad_input(self):
+        book = models.Book.objects.create(
+            name="The way of men", slug="the-way-of-men", price=Decimal("10.00"), active=False)
+        self.assertEqual(
+            self.client.get(reverse("basket_api_add"), {"book_id": book.id}).status_code, 405)
+        response = self.client.post(reverse("basket_api_add"), {"book_id": book.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("book_id", response.json()["errors"])
+        response = self.client.post(reverse("basket_api_update"), {"book_id": book.id, "quantity": -1})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.Basket.objects.exists())
+
+    def test_basket_api_uses_the_csrf_cookie_of_the_redirect_flow(self):
+        client = Client(enforce_csrf_checks=True)
+        book = models.Book.objects.create(
+            name="The way of men", slug="the-way-of-men", price=Decimal("10.00"))
+        self.assertEqual(
+            client.post(reverse("basket_api_add"), {"book_id": book.id}).status_code, 403)
+        client.get(reverse("add_to_basket"), {"book_id": book.id})
+        token = client.cookies["csrftoken"].value
+        response = client.post(
+            reverse("basket_api_add"), {"book_id": book.id}, HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.json()["count"], 2)
+
     def test_add_to_basket_login_merge_works(self):
         user1 = models.User.objects.create_user("anonymous@gmail.com", "Abcd_123")
         b1 = models.Book.objects.create(
@@ -155,4 +559,21 @@ class TestPage(TestCase):
         self.assertTrue(auth.get_user(self.client).is_authenticated)
         self.assertTrue(models.Basket.objects.filter(user=user1).exists())
         basket = models.Basket.objects.get(user=user1)
-        self.assertEquals(basket.count(),3)
\ No newline at end of file
+        self.assertEquals(basket.count(),3)
+
+    def test_catalog_export_streams_for_staff_only(self):
+        user1 = models.User.objects.create_user("user1@gmail.com", "Abcabc_123")
+        book = models.Book.objects.create(
+            name="The way of men", slug="the-way-of-men", price=Decimal("10.00"))
+        book.tags.create(name="Personal development", slug="personal-development")
+        self.client.force_login(user1)
+        response = self.client.get(reverse("catalog_export"))
+        self.assertEqual(response.status_code, 403)
+        user1.is_staff = True
+        user1.save()
+        response = self.client.get(reverse("catalog_export"), {"format": "jsonl"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('"tags": ["Personal development"]', lines[0])
@@ -0,0 +1,96 @@
+'''
+Thumbnail and derivative rendering. Nothing in here touches the
+database, so the functions can run in worker processes.
+'''
+import hashlib
+import os.path
+import posixpath
+from io import BytesIO
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+
+def content_hash(file):
+    '''Returns the sha256 hex digest of a Django File'''
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_file(field_file):
+    '''Returns the content of a stored FieldFile as bytes'''
+    with field_file.open('rb') as f:
+        return f.read()
+
+
+def render_thumbnail(data, size):
+    '''Takes the bytes of an image and returns the bytes of a JPEG thumbnail'''
+    image = Image.open(BytesIO(data))
+    image = image.convert('RGB')
+    image.thumbnail(size, Image.ANTIALIAS)
+    temp_thumb = BytesIO()
+    image.save(temp_thumb, 'JPEG')
+    return temp_thumb.getvalue()
+
+
+def render_derivatives(image, sizes, formats):
+    '''
+    Takes a decoded image and returns a list of (size name, format, width,
+    height, bytes) for every combination of ``sizes`` and ``formats``.
+    Images are never scaled up.
+    '''
+    derivatives = []
+    # Every size is resized from the original, so that resampling losses
+    # don't add up and sizes need not fit inside each other
+    for name, size in sizes.items():
+        resized = image.copy()
+        resized.thumbnail(size, Image.ANTIALIAS)
+        for image_format in formats:
+            output = BytesIO()
+            resized.save(output, image_format.upper(), quality=85)
+            derivatives.append(
+                (name, image_format, resized.width, resized.height, output.getvalue()))
+    return derivatives
+
+
+def render_all(data, thumbnail_size, sizes, formats):
+    '''Decodes an image once and returns its thumbnail and derivatives'''
+    image = Image.open(BytesIO(data)).convert('RGB')
+    derivatives = render_derivatives(image, sizes, formats)
+    thumbnail = image.copy()
+    thumbnail.thumbnail(thumbnail_size, Image.ANTIALIAS)
+    output = BytesIO()
+    thumbnail.save(output, 'JPEG')
+    return output.getvalue(), derivatives
+
+
+def ingest_image(path, known_hashes, upload_dirs, thumbnail_size, sizes, formats):
+    '''
+    Copies the image file at ``path`` into the media storage along with its
+    thumbnail and derivatives, unless its hash is in ``known_hashes``.
+    ``upload_dirs`` are the directories of the image, the thumbnail and the
+    derivatives. Returns the hash and a dict of stored names, or None.
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+    image_hash = hashlib.sha256(data).hexdigest()
+    if image_hash in known_hashes:
+        return image_hash, None
+    # Rendering first means a broken image leaves no files behind
+    thumbnail, derivatives = render_all(data, thumbnail_size, sizes, formats)
+    image_dir, thumbnail_dir, derivative_dir = upload_dirs
+    name = os.path.basename(path)
+    stem = os.path.splitext(name)[0]
+    stored = {
+        'image': default_storage.save(posixpath.join(image_dir, name), ContentFile(data)),
+        'thumbnail': default_storage.save(
+            posixpath.join(thumbnail_dir, name), ContentFile(thumbnail)),
+        'derivatives': [
+            (size, image_format, width, height, default_storage.save(
+                posixpath.join(derivative_dir, '%s-%s.%s' % (stem, size, image_format)),
+                ContentFile(derivative)))
+            for size, image_format, width, height, derivative in derivatives],
+        }
+    return image_hash, stored
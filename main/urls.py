@@ -1,5 +1,4 @@
 from django.views.generic.base import TemplateView
-from django.views.generic.detail import DetailView
 from django.urls import path, include
 from main import models, views, forms, endpoints
 from django.contrib.auth.views import LoginView
@@ -9,6 +8,7 @@ from rest_framework import routers
 router = routers.DefaultRouter()
 router.register(r'orderlines', endpoints.PaidOrderLineViewSet)
 router.register(r'orders', endpoints.PaidOrderViewSet)
+router.register(r'search', endpoints.BookSearchViewSet, basename='search')
 
 
 urlpatterns = [
@@ -20,12 +20,19 @@ urlpatterns = [
     path('address/<int:pk>/',views.AddressUpdateView.as_view(),name="address_update"),
     path('address/<int:pk>/delete/',views.AddressDeleteView.as_view(),name="address_delete"),
     path('books/<slug:tag>/', views.BookListView.as_view(), name='books'),
-    path('book/<slug:slug>/', DetailView.as_view(model=models.Book, template_name='book_detail.html'), name='book'),
+    path('search/', views.SearchView.as_view(), name='search'),
+    path('search/autocomplete/', views.autocomplete_books, name='autocomplete'),
+    path('book/<slug:slug>/', views.BookDetailView.as_view(), name='book'),
     path('basket/',views.manage_basket,name="basket"),
     path('add-to-basket/',views.add_to_basket, name="add_to_basket"),
+    path('basket/api/add/',views.basket_api_add, name="basket_api_add"),
+    path('basket/api/update/',views.basket_api_update, name="basket_api_update"),
+    path('basket/api/remove/',views.basket_api_remove, name="basket_api_remove"),
     path('order/done/',TemplateView.as_view(template_name="order_done.html"),name="checkout_done"),
     path('order/address_select/',views.AddressSelectionView.as_view(),name="address_select"),
     path('order-dashboard/',views.OrderView.as_view(),name="order_dashboard",),
+    path('catalog/export/',views.CatalogExportView.as_view(),name="catalog_export"),
+    path('catalog/cache-stats/',views.CatalogCacheStatsView.as_view(),name="catalog_cache_stats"),
     path('api/', include(router.urls)),
     
 ]
\ No newline at end of file
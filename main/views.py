@@ -1,13 +1,24 @@
+import hashlib
 import logging
+import math
 from django.contrib.auth import login, authenticate
 from django.contrib import messages
 from django.views.generic.edit import FormView, CreateView, UpdateView, DeleteView
+from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
+from django.views.generic.base import TemplateView
+from django.template.loader import render_to_string
 from django.shortcuts import render,get_object_or_404
 from django.urls import reverse_lazy,reverse
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.http import HttpResponseRedirect
-from main import models, forms
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse, Http404
+from django.views import View
+from django.views.decorators.csrf import ensure_csrf_cookie
+from django.views.decorators.http import require_POST
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils import timezone
+from main import models, forms, middlewares, autocomplete, bestsellers, catalog_cache, exceptions, exports, facets, pagination, search
 from django import forms as django_forms
 from django.db import models as django_models
 import django_filters
@@ -49,13 +60,116 @@ class ContactUsView(FormView):
         return super().form_valid(form)
 
 
-class BookListView(ListView):
+class ConditionalCatalogMixin:
+    '''
+    Answers GETs with 304 when the catalog content of the page and the
+    visitor's basket did not change, see get_catalog_state().
+
+    Pages of visitors without a basket are the same for everyone, so a
+    fronting cache may keep them for shared_max_age seconds. Others are
+    private. Browsers always revalidate, which is cheap.
+    '''
+    shared_max_age = 60
+
+    def get_catalog_state(self):
+        '''
+        Returns (last_modified, state), the last change of what the page
+        shows and anything else which changes it, like a number of books
+        '''
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        storage = messages.get_messages(request)
+        if len(storage):
+            # Pending messages are rendered once, the page must be too
+            return super().get(request, *args, **kwargs)
+        last_modified, state = self.get_catalog_state()
+        # The header badge only shows the basket summary
+        basket = middlewares.basket_summary(request)
+        viewer = (basket["basket_id"], basket["count"]) if basket else None
+        etag = quote_etag(hashlib.md5(repr((
+            self.__class__.__name__, self.kwargs, request.GET.urlencode(),
+            last_modified, state, viewer)).encode()).hexdigest())
+        # Last-Modified knows nothing of the basket, it is only sent when
+        # the page doesn't show one
+        timestamp = None
+        if last_modified and not basket:
+            timestamp = int(last_modified.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        response.headers.setdefault("ETag", etag)
+        if timestamp:
+            response.headers.setdefault("Last-Modified", http_date(timestamp))
+        if basket:
+            patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+        else:
+            patch_cache_control(
+                response, public=True, max_age=0, s_maxage=self.shared_max_age,
+                must_revalidate=True)
+        return response
+
+
+class CatalogFragmentMixin:
+    '''
+    Renders the part of the page which is the same for every visitor from
+    fragment_template_name, through the catalog cache. The page template
+    puts it in base.html, which shows the basket and messages.
+    '''
+    fragment_template_name = None
+    # Listed in the stats of CatalogCacheStatsView
+    fragment_names = (
+        "fragments/home.html", "fragments/book_list.html", "fragments/book_detail.html",
+        "facets", "facet-tags", "bestsellers")
+
+    def get_fragment_parts(self):
+        return (self.kwargs, self.request.GET.urlencode())
+
+    def get_fragment_context(self):
+        return self.get_context_data(**self.kwargs)
+
+    def render_fragment(self):
+        return render_to_string(
+            self.fragment_template_name, self.get_fragment_context(), self.request)
+
+    def get(self, request, *args, **kwargs):
+        fragment = catalog_cache.get_or_render(
+            self.fragment_template_name, self.get_fragment_parts(), self.render_fragment)
+        # Not render_to_response(), on a hit the view has no object to
+        # derive template names from
+        return self.response_class(
+            request=request, template=[self.template_name],
+            context={"view": self, "fragment": fragment}, using=self.template_engine)
+
+
+class HomeView(CatalogFragmentMixin, TemplateView):
+    template_name = "home.html"
+    fragment_template_name = "fragments/home.html"
+    bestseller_days = 30
+    bestseller_count = 5
+
+    def get_fragment_parts(self):
+        # The bestsellers block follows the orders as well as the catalog
+        return super().get_fragment_parts() + (
+            catalog_cache.sales_version(), timezone.localdate().isoformat())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["bestsellers"] = bestsellers.top_books(
+            self.bestseller_days, self.bestseller_count, active_only=True)
+        context["bestseller_days"] = self.bestseller_days
+        return context
+
+
+class BookListView(ConditionalCatalogMixin, CatalogFragmentMixin, ListView):
     '''
     Depending on the content of kwargs, this view returns a 
     list of active books belonging to that tag, or simply all active ones if the
-    tag all is specified
+    tag all is specified. The query string narrows it down further with
+    facets, see main.facets
     '''
     template_name = "book_list.html"
+    fragment_template_name = "fragments/book_list.html"
     paginate_by = 5
 
     def get_queryset(self):
@@ -65,10 +179,113 @@ class BookListView(ListView):
             self.tag = get_object_or_404(
                 models.BookTag, slug=tag)
         if self.tag:
-            books = models.Book.objects.active().filter(tags=self.tag)
+            self.books = models.Book.objects.active().filter(tags=self.tag)
         else:
-            books = models.Book.objects.active()
-        return books.order_by("name")
+            self.books = models.Book.objects.active()
+        self.selection = facets.Selection(self.request.GET)
+        # The covers of the page, with their derivatives for the srcset
+        return self.selection.filter(self.books).order_by("name", "id").prefetch_related(
+            django_models.Prefetch(
+                "bookimage_set",
+                queryset=models.BookImage.objects.order_by("id").prefetch_related("derivatives")))
+
+    def paginate_queryset(self, queryset, page_size):
+        # Keyset pagination over (name, id): deep pages cost the same as
+        # the first one and no COUNT(*) is needed
+        paginator = pagination.KeysetPaginator(queryset, page_size)
+        page = paginator.page(self.request.GET.get("cursor"))
+        return (paginator, page, page.object_list, page.has_next() or page.has_previous())
+
+    def get_fragment_context(self):
+        self.object_list = self.get_queryset()
+        return self.get_context_data()
+
+    def get_catalog_state(self):
+        # Inactive books count too, deactivating one touches it and
+        # removes it from the page
+        books = models.Book.objects.all()
+        if self.kwargs["tag"] != "all":
+            books = books.filter(tags__slug=self.kwargs["tag"])
+        state = books.aggregate(
+            last_modified=django_models.Max("date_updated"), count=django_models.Count("id"))
+        # Facets list every tag
+        tags_modified = models.BookTag.objects.aggregate(
+            last_modified=django_models.Max("date_updated"))["last_modified"]
+        last_modified = max(
+            filter(None, [state["last_modified"], tags_modified]), default=None)
+        return last_modified, state["count"]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["tag"] = self.tag
+        # The facet counts include the total, which gives the page estimate
+        counts = self.selection.counts(self.books, self.kwargs["tag"])
+        context["facets"] = counts
+        context["selection"] = self.selection
+        context["page_count_estimate"] = math.ceil(counts["total"] / self.paginate_by)
+        return context
+
+
+class BookDetailView(ConditionalCatalogMixin, CatalogFragmentMixin, DetailView):
+    '''
+    A book with its tags, images (derivatives included) and recommendations
+    in five queries whatever their number
+    '''
+    template_name = "book_detail.html"
+    fragment_template_name = "fragments/book_detail.html"
+    queryset = models.Book.objects.prefetch_related(
+        "tags",
+        django_models.Prefetch(
+            "bookimage_set",
+            queryset=models.BookImage.objects.order_by("id").prefetch_related("derivatives")),
+        django_models.Prefetch(
+            "recommendations",
+            queryset=models.BookRecommendation.objects.filter(
+                recommended__active=True).select_related("recommended")),
+        )
+
+    def get_fragment_context(self):
+        self.object = self.get_object()
+        return self.get_context_data(object=self.object)
+
+    def get_catalog_state(self):
+        # Tag and image changes touch the book, renamed tags don't. The
+        # recommended books are shown too, and a rebuild of the
+        # recommendations bumps their version
+        state = models.Book.objects.filter(slug=self.kwargs["slug"]).aggregate(
+            last_modified=django_models.Max("date_updated"),
+            tags_modified=django_models.Max("tags__date_updated"),
+            recommended_modified=django_models.Max("recommendations__recommended__date_updated"))
+        last_modified = max(
+            filter(None, state.values()), default=None)
+        return last_modified, catalog_cache.recommendations_version()
+
+
+class SearchView(ListView):
+    '''
+    Active books matching the words in ?q=, best match first
+    '''
+    template_name = "search.html"
+    paginate_by = 10
+
+    def get_queryset(self):
+        self.query = self.request.GET.get("q", "").strip()
+        return search.search(self.query)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.query
+        return context
+
+
+def autocomplete_books(request):
+    '''Title suggestions for the search box, served from memory'''
+    try:
+        limit = min(int(request.GET.get("limit", 10)), 50)
+    except ValueError:
+        limit = 10
+    return JsonResponse(
+        {"results": autocomplete.suggest(request.GET.get("q", ""), limit)})
 
 
 class AddressListView(LoginRequiredMixin, ListView):
@@ -111,35 +328,84 @@ class AddressDeleteView(LoginRequiredMixin, DeleteView):
         return self.model.objects.filter(user=self.request.user)
     
     
+@ensure_csrf_cookie
 def add_to_basket(request):
+    # The redirecting flow of clients without JavaScript. The CSRF cookie
+    # is set here so that the next adds can go through the basket API
     book = get_object_or_404(models.Book, pk=request.GET.get("book_id"))
-    basket = request.basket
-    if not request.basket:
-        if request.user.is_authenticated:
-            user = request.user
-        else:
-            user = None
-        basket = models.Basket.objects.create(user=user)
-        request.session["basket_id"] = basket.id
-    basketline, created = models.BasketLine.objects.get_or_create(basket=basket, book=book)
-    if not created:
-        basketline.quantity += 1
-        basketline.save()
+    basket = request.basket or middlewares.create_basket(request)
+    basket.add(book)
+    middlewares.forget_basket_summary(request)
     return HttpResponseRedirect(reverse("book", args=(book.slug,)))
 
+
+def basket_api_response(request, book):
+    '''The quantity of book in the basket and the new basket summary'''
+    middlewares.forget_basket_summary(request)
+    summary = middlewares.basket_summary(request) or {"lines": 0, "count": 0}
+    quantity = 0
+    if request.session.get("basket_id") is not None:
+        quantity = models.BasketLine.objects.filter(
+            basket_id=request.session["basket_id"], book=book
+            ).values_list("quantity", flat=True).first() or 0
+    return JsonResponse({
+        "book_id": book.id, "quantity": quantity,
+        "lines": summary["lines"], "count": summary["count"]})
+
+
+@require_POST
+def basket_api_add(request):
+    form = forms.BasketAddForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+    book = form.cleaned_data["book_id"]
+    basket = request.basket or middlewares.create_basket(request)
+    basket.add(book, form.cleaned_data["quantity"] or 1)
+    return basket_api_response(request, book)
+
+
+@require_POST
+def basket_api_update(request):
+    form = forms.BasketLineForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+    book = form.cleaned_data["book_id"]
+    quantity = form.cleaned_data["quantity"]
+    if request.basket:
+        request.basket.set_quantity(book, quantity)
+    elif quantity:
+        middlewares.create_basket(request).set_quantity(book, quantity)
+    return basket_api_response(request, book)
+
+
+@require_POST
+def basket_api_remove(request):
+    form = forms.BasketRemoveForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+    book = form.cleaned_data["book_id"]
+    if request.basket:
+        request.basket.remove(book)
+    return basket_api_response(request, book)
+
 def manage_basket(request):
-    formset = forms.BasketLineFormSet(instance=request.basket)
+    # request.basket is lazy, a missing basket must be caught before the
+    # formset gets it
     if not request.basket:
         return render(request, "basket.html", {"formset": None})
+    lines = models.BasketLine.objects.select_related("book").order_by("id")
     if request.method == "POST":
-        formset = forms.BasketLineFormSet(request.POST, instance=request.basket)
+        formset = forms.BasketLineFormSet(request.POST, instance=request.basket, queryset=lines)
         if formset.is_valid():
             formset.save()
-        else:
-            formset
-    if request.basket.is_empty():
+            request.basket.touch()
+            middlewares.forget_basket_summary(request)
+    else:
+        formset = forms.BasketLineFormSet(instance=request.basket, queryset=lines)
+    totals = request.basket.totals()
+    if not totals["line_count"]:
         return render(request, "basket.html", {"formset": None})
-    return render(request, "basket.html", {"formset": formset})
+    return render(request, "basket.html", {"formset": formset, "totals": totals})
 
 class AddressSelectionView(LoginRequiredMixin, FormView):
     template_name = "address_select.html"
@@ -152,11 +418,18 @@ class AddressSelectionView(LoginRequiredMixin, FormView):
         return kwargs
     
     def form_valid(self, form):
-        del self.request.session['basket_id']
         basket = self.request.basket
-        basket.create_order(
-            form.cleaned_data['billing_address'],
-            form.cleaned_data['shipping_address'])
+        if not basket:
+            return HttpResponseRedirect(reverse("basket"))
+        try:
+            basket.create_order(
+                form.cleaned_data['billing_address'],
+                form.cleaned_data['shipping_address'])
+        except exceptions.BasketException as e:
+            logger.warning("Checkout refused for basket %d: %s", basket.id, e)
+            messages.error(self.request, "This basket could not be ordered.")
+            return HttpResponseRedirect(reverse("basket"))
+        middlewares.forget_basket(self.request)
         return super().form_valid(form)
     
         
@@ -182,4 +455,37 @@ class OrderView(UserPassesTestMixin, FilterView):
     login_url = reverse_lazy("login")
     
     def test_func(self):
-        return self.request.user.is_staff is True
\ No newline at end of file
+        return self.request.user.is_staff is True
+
+
+class CatalogExportView(UserPassesTestMixin, View):
+    login_url = reverse_lazy("login")
+
+    def test_func(self):
+        return self.request.user.is_staff is True
+
+    def get(self, request):
+        export_format = request.GET.get("format", "csv")
+        if export_format not in exports.FORMATS:
+            raise Http404("Unknown export format")
+        lines, content_type = exports.FORMATS[export_format]
+        response = StreamingHttpResponse(
+            lines(exports.catalog_books(request.GET.get("active") == "1")),
+            content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="catalog.%s"' % export_format
+        return response
+
+
+class CatalogCacheStatsView(UserPassesTestMixin, View):
+    '''Hit and miss counters of the catalog cache, POST resets them'''
+    login_url = reverse_lazy("login")
+
+    def test_func(self):
+        return self.request.user.is_staff is True
+
+    def get(self, request):
+        return JsonResponse(catalog_cache.stats(CatalogFragmentMixin.fragment_names))
+
+    def post(self, request):
+        catalog_cache.reset_stats(CatalogFragmentMixin.fragment_names)
+        return JsonResponse(catalog_cache.stats(CatalogFragmentMixin.fragment_names))